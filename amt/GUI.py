@@ -5,56 +5,136 @@ import sounddevice as sd
 import pyqtgraph as pg
 import numpy as np
 import librosa
-import queue
+import time
+import os
 
 from amt import utils
+from amt.cache import FeatureCache
 from amt.entities import Track
-from amt.utils import open_wav, Instrument
+from amt.jobs import CancelToken, TranscriptionCancelled
+from amt.live import LiveTranscriber
+from amt.recorder import Recorder, RingBuffer
+from amt.utils import open_wav, validate_dictionaries, Instrument
 
 
 class WorkerTranscribe(QtCore.QObject):
     working_track = QtCore.pyqtSignal(Track)
+    working_display_cqt = QtCore.pyqtSignal(Track)
+    progress = QtCore.pyqtSignal(str, float)
 
-    @QtCore.pyqtSlot(Track, float, int, int, int, int, int, Instrument, tuple)
+    @QtCore.pyqtSlot(Track, float, int, int, int, int, int, Instrument, tuple, CancelToken, bool)
     def transcribe(self, track, slider_plca_threshold, slider_note_length_threshold, slider_onset_range,
-                   slider_previous_note_range, slider_pre_max, slider_post_max, instrument, time_signature):
-        track.transcribe(slider_plca_threshold,
-                         slider_note_length_threshold,
-                         slider_onset_range,
-                         slider_previous_note_range,
-                         slider_pre_max,
-                         slider_post_max,
-                         instrument,
-                         time_signature)
+                   slider_previous_note_range, slider_pre_max, slider_post_max, instrument, time_signature, cancel,
+                   display_cqt):
+        # Jobs superseded while still queued are skipped, a running one stops at its next stage or PLCA step
+        if cancel.cancelled:
+            return
+        try:
+            track.transcribe(slider_plca_threshold,
+                             slider_note_length_threshold,
+                             slider_onset_range,
+                             slider_previous_note_range,
+                             slider_pre_max,
+                             slider_post_max,
+                             instrument,
+                             time_signature,
+                             progress=self.progress.emit,
+                             cancel=cancel,
+                             progress_step=None)
+        except TranscriptionCancelled:
+            return
+        # The display CQT is computed here rather than on the UI thread when the CQT view is drawn
+        if display_cqt and not track.has_display_cqt:
+            self.progress.emit('display_cqt', 0.0)
+            track.display_cqt
+            if cancel.cancelled:
+                return
         self.working_track.emit(track)
 
+    @QtCore.pyqtSlot(Track)
+    def display_cqt(self, track):
+        track.display_cqt
+        self.working_display_cqt.emit(track)
+
 
 class WorkerRecord(QtCore.QObject):
-    working_recording = QtCore.pyqtSignal(np.ndarray)
+    working_recording = QtCore.pyqtSignal(np.ndarray, str)
     is_recording = False
-    data_queue = queue.Queue()
+    # Seconds between moving recorded samples from the ring buffer to disk
+    drain_interval = 0.05
 
     @QtCore.pyqtSlot()
     def recording(self):
         self.is_recording = True
-        waveform = []
+        recorder = Recorder()
+        self.recording_path = recorder.path
         with sd.InputStream(
                 samplerate=utils.SAMPLE_RATE,
                 channels=utils.CHANNELS,
-                callback=self.callback):
+                dtype='float32',
+                callback=recorder.callback):
             while self.is_recording:
-                frame = self.data_queue.get()
-                waveform.append(frame)
-        self.data_queue = queue.Queue()
-        self.working_recording.emit(np.array(waveform).flatten())
-
-    def callback(self, indata, frames, time, status):
-        self.data_queue.put(indata.copy())
+                time.sleep(self.drain_interval)
+                recorder.drain()
+        self.working_recording.emit(recorder.close(), recorder.path)
+
+
+class WorkerLive(QtCore.QObject):
+    live_events = QtCore.pyqtSignal(list)
+    live_piano_roll = QtCore.pyqtSignal(np.ndarray)
+    live_finished = QtCore.pyqtSignal(LiveTranscriber)
+    is_listening = False
+    # Frames between piano roll redraws
+    redraw_frames = 4
+    # Seconds of audio held while PLCA catches up, audio arriving when the ring is full is dropped and counted
+    ring_seconds = 1
+    # Seconds to wait for audio when none is pending
+    poll_interval = 0.005
+
+    @QtCore.pyqtSlot(float, Instrument)
+    def listening(self, plca_threshold, instrument):
+        self.is_listening = True
+        # The audio callback only copies into the ring and stamps the time, every push takes all pending samples
+        self.ring = RingBuffer(int(self.ring_seconds * utils.SAMPLE_RATE))
+        self.arrival = (0, time.perf_counter())
+        transcriber = LiveTranscriber(instrument=instrument, plca_threshold=plca_threshold)
+        drawn_frame = 0
+        with sd.InputStream(
+                samplerate=utils.SAMPLE_RATE,
+                channels=utils.CHANNELS,
+                blocksize=utils.HOP_LENGTH,
+                dtype='float32',
+                callback=self.callback):
+            while self.is_listening:
+                # Only the samples up to the last time stamp are taken, so their arrival time is known
+                written, arrival_time = self.arrival
+                samples = np.concatenate(self.ring.read_available())[:written - self.ring.read]
+                if len(samples) == 0:
+                    time.sleep(self.poll_interval)
+                    continue
+                self.ring.release(len(samples))
+                events = transcriber.push(samples, arrival_time)
+                if events:
+                    self.live_events.emit(events)
+                if transcriber.frame - drawn_frame >= self.redraw_frames:
+                    self.live_piano_roll.emit(transcriber.piano_roll.astype(np.uint8))
+                    drawn_frame = transcriber.frame
+        self.live_events.emit(transcriber.finish())
+        if self.ring.dropped:
+            print('Live transcription dropped %d samples, PLCA fell behind.' % self.ring.dropped)
+        self.live_finished.emit(transcriber)
+
+    def callback(self, indata, frames, time_info, status):
+        self.ring.write(indata)
+        self.arrival = (self.ring.written, time.perf_counter())
 
 
 class Ui_MainWindow(QtWidgets.QMainWindow):
-    transcribe_requested = QtCore.pyqtSignal(Track, float, int, int, int, int, int, Instrument, tuple)
+    transcribe_requested = QtCore.pyqtSignal(Track, float, int, int, int, int, int, Instrument, tuple, CancelToken,
+                                             bool)
+    display_cqt_requested = QtCore.pyqtSignal(Track)
     record_start_requested = QtCore.pyqtSignal()
+    live_start_requested = QtCore.pyqtSignal(float, Instrument)
 
     def __init__(self):
         super().__init__()
@@ -75,15 +155,29 @@ class Ui_MainWindow(QtWidgets.QMainWindow):
         self.worker_record.moveToThread(self.worker_record_thread)
         self.worker_record_thread.start()
 
+        self.worker_live = WorkerLive()
+        self.worker_live_thread = QtCore.QThread()
+        self.worker_live.moveToThread(self.worker_live_thread)
+        self.worker_live_thread.start()
+
         # Connect signals and slots
         self.worker_transcribe.working_track.connect(self.draw_graph)
+        self.worker_transcribe.progress.connect(self.transcribe_progress)
         self.transcribe_requested.connect(self.worker_transcribe.transcribe)
+        self.worker_transcribe.working_display_cqt.connect(self.display_cqt_finished)
+        self.display_cqt_requested.connect(self.worker_transcribe.display_cqt)
 
         self.worker_record.working_recording.connect(self.recording_finished)
         self.record_start_requested.connect(self.worker_record.recording)
 
+        self.worker_live.live_events.connect(self.live_events)
+        self.worker_live.live_piano_roll.connect(self.graph)
+        self.worker_live.live_finished.connect(self.live_finished)
+        self.live_start_requested.connect(self.worker_live.listening)
+
         # Non UI Components
-        self.track = Track()
+        self.track = Track(feature_cache=FeatureCache())
+        self.check_dictionaries()
 
     def UiComponents(self):
         # Import Wav File HBox
@@ -103,6 +197,10 @@ class Ui_MainWindow(QtWidgets.QMainWindow):
         self.button_record = QtWidgets.QPushButton("Start Recording", self)
         self.button_record.clicked.connect(self.recording)
         self.button_record.setGeometry(QtCore.QRect(600, 700, 100, 100))
+        # Live Button
+        self.button_live = QtWidgets.QPushButton("Start Live", self)
+        self.button_live.clicked.connect(self.live)
+        self.button_live.setGeometry(QtCore.QRect(720, 700, 100, 100))
 
         # Transcribe Options
         # Time Signature Box
@@ -128,6 +226,9 @@ class Ui_MainWindow(QtWidgets.QMainWindow):
         vbox_transcribe_option_container = QtWidgets.QVBoxLayout()
         vbox_transcribe_option_container.addWidget(self.groupbox_instrument_options)
         vbox_transcribe_option_container.addWidget(self.button_transcribe)
+        self.progress_transcribe = QtWidgets.QProgressBar(self)
+        self.progress_transcribe.setRange(0, 100)
+        vbox_transcribe_option_container.addWidget(self.progress_transcribe)
         # Threshold Parameters
         # PLCA Threshold Slider
         self.slider_plca_threshold = QtWidgets.QSlider(QtCore.Qt.Horizontal, self)
@@ -250,6 +351,14 @@ class Ui_MainWindow(QtWidgets.QMainWindow):
         grid_parameter_estimations.addWidget(self.label_tempo_estimate, 0, 1)
         grid_parameter_estimations.addWidget(self.label_key_name, 1, 0)
         grid_parameter_estimations.addWidget(self.label_key_estimate, 1, 1)
+        self.label_live_notes_name = QtWidgets.QLabel("Live Notes:", self)
+        self.label_live_notes = QtWidgets.QLabel("", self)
+        self.label_latency_name = QtWidgets.QLabel("Latency:", self)
+        self.label_latency = QtWidgets.QLabel("", self)
+        grid_parameter_estimations.addWidget(self.label_live_notes_name, 2, 0)
+        grid_parameter_estimations.addWidget(self.label_live_notes, 2, 1)
+        grid_parameter_estimations.addWidget(self.label_latency_name, 3, 0)
+        grid_parameter_estimations.addWidget(self.label_latency, 3, 1)
         self.groupbox_parameter_estimations.setLayout(grid_parameter_estimations)
         self.groupbox_parameter_estimations.setGeometry(QtCore.QRect(1100, 450, 200, 200))
 
@@ -324,6 +433,20 @@ class Ui_MainWindow(QtWidgets.QMainWindow):
         self.p1.setLabel('bottom', "Time", units='s')
         self.toggle_y_axis()
         self.vline_objects = []
+        self.live_notes = set()
+        self.recording_path = None
+        self.transcribe_cancel = None
+
+    def check_dictionaries(self):
+        # Instruments without a usable dictionary can not be selected
+        errors = validate_dictionaries()
+        if Instrument.GUITAR in errors:
+            self.radio_guitar_option.setEnabled(False)
+            self.radio_guitar_option.setToolTip(errors[Instrument.GUITAR])
+        if Instrument.PIANO in errors:
+            self.radio_piano_option.setEnabled(False)
+            self.radio_piano_option.setToolTip(errors[Instrument.PIANO])
+            QtWidgets.QMessageBox.critical(self, 'Dictionary Issue', errors[Instrument.PIANO])
 
     def toggle_onset_lines(self):
         if not self.vline_objects:
@@ -377,10 +500,13 @@ class Ui_MainWindow(QtWidgets.QMainWindow):
         newLeftTicks.setTicks([major_f_ticks, minor_f_ticks])
 
     def toggle_output_view(self):
-        if self.radio_cqt_option.isChecked() and self.track.display_cqt is not None:
+        if self.radio_cqt_option.isChecked() and not self.track.has_display_cqt:
+            # Computed on the transcription thread, the view is drawn by display_cqt_finished
+            self.display_cqt_requested.emit(self.track)
+        elif self.radio_cqt_option.isChecked() and self.track.display_cqt is not None:
             self.graph(np.abs(self.track.display_cqt))
         elif self.radio_plca_option.isChecked() and self.track.piano_roll is not None:
-            self.graph(self.track.piano_roll)
+            self.graph(self.track.piano_roll.to_dense(np.uint8))
         self.toggle_y_axis()
 
     def wav_file_open(self):
@@ -397,6 +523,7 @@ class Ui_MainWindow(QtWidgets.QMainWindow):
                     raise Exception('Imported file must be a .wav')
                 wav_file = open_wav(path=wav_file_path)
                 self.track.samples = wav_file.read()
+                self.remove_recording()
                 self.transcribe()
             except Exception as e:
                 QtWidgets.QMessageBox.critical(self, 'Wav Import Issue', str(e))
@@ -415,6 +542,11 @@ class Ui_MainWindow(QtWidgets.QMainWindow):
             time_signature = (4, 4)
         else:
             time_signature = (3, 4)
+        # A new request supersedes the one still running or queued, only the latest is drawn
+        if self.transcribe_cancel is not None:
+            self.transcribe_cancel.cancel()
+        self.transcribe_cancel = CancelToken()
+        self.progress_transcribe.setValue(0)
         self.transcribe_requested.emit(self.track,
                                        self.slider_plca_threshold.value() / 100,
                                        self.slider_note_length_threshold.value(),
@@ -423,12 +555,50 @@ class Ui_MainWindow(QtWidgets.QMainWindow):
                                        self.slider_pre_max.value(),
                                        self.slider_post_max.value(),
                                        instrument,
-                                       time_signature)
+                                       time_signature,
+                                       self.transcribe_cancel,
+                                       self.radio_cqt_option.isChecked())
+
+    def transcribe_progress(self, stage, fraction):
+        self.progress_transcribe.setFormat(stage + ' %p%')
+        self.progress_transcribe.setValue(int(fraction * 100))
 
-    def recording_finished(self, samples):
+    def recording_finished(self, samples, path):
+        # The samples are a memory map of the recording on disk, the previous recording is no longer needed
         self.track.samples = samples
+        self.remove_recording()
+        self.recording_path = path
         self.transcribe()
 
+    def remove_recording(self):
+        # Removes the raw file of the last recording once the track no longer uses it
+        if self.recording_path is not None:
+            try:
+                os.remove(self.recording_path)
+            except OSError:
+                pass
+            self.recording_path = None
+
+    def closeEvent(self, event):
+        # A recording still running is stopped and its file removed along with the last one
+        if self.transcribe_cancel is not None:
+            self.transcribe_cancel.cancel()
+        if self.worker_record.is_recording:
+            self.worker_record.is_recording = False
+            self.worker_record_thread.quit()
+            self.worker_record_thread.wait()
+            try:
+                os.remove(self.worker_record.recording_path)
+            except OSError:
+                pass
+        self.remove_recording()
+        super().closeEvent(event)
+
+    def display_cqt_finished(self, track):
+        # Skipped when another track was loaded in the meantime
+        if track is self.track:
+            self.toggle_output_view()
+
     def export_midi(self):
         file = QtWidgets.QFileDialog.getSaveFileName(self,
                                                      "Save MIDI File",
@@ -442,6 +612,8 @@ class Ui_MainWindow(QtWidgets.QMainWindow):
 
     def draw_graph(self, track):
         self.track = track
+        self.progress_transcribe.setFormat('Done')
+        self.progress_transcribe.setValue(100)
         self.label_tempo_estimate.setText(str(self.track.tempo) + "BPM")
         self.label_key_estimate.setText(self.track.key.to_display())
         self.toggle_output_view()
@@ -494,6 +666,38 @@ class Ui_MainWindow(QtWidgets.QMainWindow):
             self.worker_record.is_recording = False
             self.button_record.setText('Start Recording')
 
+    def live(self):
+        if self.button_live.text() == 'Start Live':
+            if self.radio_piano_option.isChecked():
+                instrument = Instrument.PIANO
+            else:
+                instrument = Instrument.GUITAR
+            self.button_live.setText('Stop Live')
+            self.radio_plca_option.setChecked(True)
+            self.live_notes = set()
+            self.live_start_requested.emit(self.slider_plca_threshold.value() / 100, instrument)
+        else:
+            self.worker_live.is_listening = False
+            self.button_live.setText('Start Live')
+
+    def live_events(self, events):
+        for event in events:
+            if event.kind == 'note_on':
+                self.live_notes.add(event.midi_number)
+            else:
+                self.live_notes.discard(event.midi_number)
+        self.label_live_notes.setText(' '.join(librosa.midi_to_note(sorted(self.live_notes))))
+
+    def live_finished(self, transcriber):
+        if not transcriber.latencies:
+            return
+        counts, bins = transcriber.latency_histogram()
+        for count, low, high in zip(counts, bins[:-1], bins[1:]):
+            if count:
+                print('Latency %3d-%3d ms: %d frames' % (low, high, count))
+        self.label_latency.setText('%.0f ms median, %.0f ms 95th' % (transcriber.latency_percentile(50),
+                                                                 transcriber.latency_percentile(95)))
+
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_Space:
             print('key pressed')
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'amt')
+DEFAULT_CACHE_SIZE = 2 * 2 ** 30
+# Part of every key, entries written in an older layout are never read and age out of the cache
+CACHE_FORMAT = 2
+
+
+def hash_array(array):
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha256(str((array.dtype.str, array.shape)).encode())
+    digest.update(array.data)
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    # Content addressed store of feature arrays on disk. Each entry is a directory of .npy files and a count file
+    # named by the hash of its key, entries are loaded memory mapped and evicted least recently used first once
+    # the cache grows past max_size bytes
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, *parts):
+        return hashlib.sha256(repr((CACHE_FORMAT,) + parts).encode()).hexdigest()
+
+    def load(self, key):
+        # An entry being evicted by another process may be partly deleted, any missing array makes it a miss.
+        # Arrays already mapped stay readable after their files are removed
+        path = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(path, 'count')) as count_file:
+                count = int(count_file.read())
+            arrays = [np.load(os.path.join(path, '{}.npy'.format(i)), mmap_mode='r') for i in range(count)]
+            # The modification time of an entry is its last use
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return arrays
+
+    def store(self, key, arrays):
+        # Entries are written to a temporary directory and renamed into place, so a concurrent reader or writer
+        # of the same key never sees a partial entry
+        path = os.path.join(self.directory, key)
+        temp_path = tempfile.mkdtemp(dir=self.directory, prefix='.tmp')
+        for i, array in enumerate(arrays):
+            np.save(os.path.join(temp_path, '{}.npy'.format(i)), array)
+        with open(os.path.join(temp_path, 'count'), 'w') as count_file:
+            count_file.write(str(len(arrays)))
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            shutil.rmtree(temp_path, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.tmp') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except FileNotFoundError:
+                continue
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
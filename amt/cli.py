@@ -0,0 +1,140 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from amt.cache import FeatureCache
+from amt.entities import Track
+from amt.plca import PLCA_METHODS
+from amt.utils import open_wav, validate_dictionaries, Instrument, PLCA_MAXSTEP
+
+INSTRUMENTS = {'piano': Instrument.PIANO, 'guitar': Instrument.GUITAR}
+TIME_SIGNATURES = {'4/4': (4, 4), '3/4': (3, 4)}
+
+
+def get_parser():
+    # Defaults match the GUI sliders
+    parser = argparse.ArgumentParser(description='Transcribe wav files to MIDI without the GUI.')
+    parser.add_argument('inputs', nargs='+',
+                        help='wav files, directories of wav files or manifests listing one wav file per line')
+    parser.add_argument('-o', '--output-dir', default='.', help='where the MIDI and JSON files are written')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--plca-threshold', type=float, default=0.10)
+    parser.add_argument('--note-length-threshold', type=int, default=2)
+    parser.add_argument('--onset-range', type=int, default=4)
+    parser.add_argument('--previous-note-range', type=int, default=8)
+    parser.add_argument('--pre-max', type=int, default=6)
+    parser.add_argument('--post-max', type=int, default=6)
+    parser.add_argument('--instrument', choices=sorted(INSTRUMENTS), default='piano')
+    parser.add_argument('--time-signature', choices=sorted(TIME_SIGNATURES), default='4/4')
+    parser.add_argument('--plca-method', choices=sorted(PLCA_METHODS), default='matrix', help='PLCA engine')
+    parser.add_argument('--plca-maxstep', type=int, default=PLCA_MAXSTEP,
+                        help='most PLCA iterations, engines that converge faster need fewer')
+    parser.add_argument('--float32', action='store_true', help='run the CQT and PLCA in single precision')
+    parser.add_argument('--plca-init', choices=['random', 'projection'], default='random',
+                        help='start PLCA from random activations or from the CQT projected on the dictionary')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random PLCA start, so runs are repeatable')
+    parser.add_argument('--stream', action='store_true',
+                        help='transcribe in blocks without loading whole files, for long recordings')
+    parser.add_argument('--cache-dir', default=None, help='keep CQTs and activations in a feature cache here')
+    return parser
+
+
+def find_wav_files(inputs):
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            paths.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.lower().endswith('.wav')))
+        elif path.lower().endswith('.wav'):
+            paths.append(path)
+        else:
+            # Manifest paths are relative to the manifest
+            with open(path) as manifest:
+                paths.extend(os.path.join(os.path.dirname(path), line.strip()) for line in manifest
+                             if line.strip() and not line.startswith('#'))
+    # A file listed twice is transcribed once
+    unique_paths = {}
+    for path in paths:
+        unique_paths.setdefault(os.path.abspath(path), path)
+    return list(unique_paths.values())
+
+
+def get_output_names(paths):
+    # Outputs mirror where the inputs are relative to the directory they all share, so files with the same name
+    # in different directories do not overwrite each other
+    if not paths:
+        return []
+    absolute_paths = [os.path.abspath(path) for path in paths]
+    common = os.path.dirname(absolute_paths[0]) if len(paths) == 1 else os.path.commonpath(absolute_paths)
+    return [os.path.splitext(os.path.relpath(path, common))[0] for path in absolute_paths]
+
+
+def transcribe_file(path, output_path, options):
+    # output_path is where the MIDI and JSON files go, without their extensions
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    summary = {'file': path}
+    try:
+        feature_cache = None
+        if options['cache_dir'] is not None:
+            feature_cache = FeatureCache(options['cache_dir'])
+        track = Track(feature_cache=feature_cache)
+        parameters = (options['plca_threshold'], options['note_length_threshold'], options['onset_range'],
+                      options['previous_note_range'], options['pre_max'], options['post_max'],
+                      INSTRUMENTS[options['instrument']], TIME_SIGNATURES[options['time_signature']])
+        plca_options = {'method': options['plca_method'], 'maxstep': options['plca_maxstep'], 'progress_step': None,
+                        'init': options['plca_init'], 'seed': options['seed']}
+        if options['float32']:
+            plca_options['dtype'] = np.float32
+        if options['stream']:
+            track.transcribe_stream(path, *parameters, **plca_options)
+        else:
+            with open_wav(path) as wav_file:
+                track.samples = wav_file.read()
+            track.transcribe(*parameters, **plca_options)
+        track.to_midi_file(output_path + '.mid')
+        summary.update({'tempo': track.tempo, 'key': str(track.key), 'note_count': len(track.notes),
+                        'timings': track.timings})
+    except Exception as e:
+        summary['error'] = str(e)
+    summary['total_time'] = time.perf_counter() - start
+    with open(output_path + '.json', 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    return summary
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    options = vars(args)
+    # Checked before any work starts, the worker processes then share the loaded dictionary
+    errors = validate_dictionaries([INSTRUMENTS[args.instrument]])
+    if errors:
+        parser.error(errors[INSTRUMENTS[args.instrument]])
+    for path in args.inputs:
+        if not os.path.exists(path):
+            parser.error('{} does not exist'.format(path))
+    paths = find_wav_files(args.inputs)
+    output_paths = [os.path.join(args.output_dir, name) for name in get_output_names(paths)]
+    if len(set(output_paths)) < len(output_paths):
+        parser.error('some inputs would be written to the same output, e.g. a.wav and a.WAV')
+    os.makedirs(args.output_dir, exist_ok=True)
+    failed = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(paths) or 1))) as pool:
+        futures = [pool.submit(transcribe_file, path, output_path, options)
+                   for path, output_path in zip(paths, output_paths)]
+        for future in as_completed(futures):
+            summary = future.result()
+            if 'error' in summary:
+                failed += 1
+                print('{}: failed, {}'.format(summary['file'], summary['error']))
+            else:
+                print('{}: {} BPM, {}, {} notes in {:.1f}s'.format(summary['file'], summary['tempo'], summary['key'],
+                                                                  summary['note_count'], summary['total_time']))
+    print('Transcribed {} of {} files in {:.1f}s'.format(len(paths) - failed, len(paths), time.perf_counter() - start))
+    return 1 if failed else 0
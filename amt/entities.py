@@ -1,61 +1,169 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from amt import utils
-from amt.utils import estimate_tempo, estimate_piano_roll, estimate_onset_times, smooth_onsets, round_to_sixteenth, \
-    rotate, Instrument
+from amt.cache import hash_array
+from amt.utils import estimate_onset_envelope, estimate_tempo, estimate_cqt, estimate_display_cqt, load_dictionary, \
+    get_activations, estimate_onset_times, round_to_sixteenth, rotate, get_minimum_frames, stream_activation_runs, \
+    open_wav, estimate_batch_cqt, get_batch_activations, PianoRoll, Instrument
 import numpy as np
-import scipy.stats
 import librosa
+import time
 from enum import Enum
 from midiutil import MIDIFile
 import midiutil
 
 
+def get_key_profiles():
+    # Krumhansl profiles for the 12 major then 12 minor keys, centred and scaled to unit length so the Pearson
+    # correlation with a centred, unit length distribution is a dot product
+    profiles = np.array([rotate(utils.KRUMHANSL_MAJ, i) for i in range(12)] +
+                        [rotate(utils.KRUMHANSL_MIN, i) for i in range(12)])
+    profiles -= np.mean(profiles, axis=1, keepdims=True)
+    return profiles / np.linalg.norm(profiles, axis=1, keepdims=True)
+
+
+KEY_PROFILES = get_key_profiles()
+
+
+def get_pitch_class_distribution(notes):
+    return np.bincount(notes.pitch_index % len(utils.PITCH_CLASSES), weights=notes.total_beat,
+                       minlength=len(utils.PITCH_CLASSES))
+
+
+def estimate_keys(distributions):
+    # Scores a batch of pitch class distributions, shape (n, 12), against every key in one matrix product.
+    # Distributions with no variance score nan everywhere and fall back to C Major
+    distributions = np.asarray(distributions, dtype=float)
+    distributions = distributions - np.mean(distributions, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distributions /= np.linalg.norm(distributions, axis=1, keepdims=True)
+    max_scores = np.argmax(distributions @ KEY_PROFILES.T, axis=1)
+    return [Key(pitch_class=KeyName(max_score % 12), scale=Scale(max_score // 12)) for max_score in max_scores]
+
+
 def estimate_key(notes):
-    pitch_class_dict = dict.fromkeys(utils.PITCH_CLASSES, 0)
-    for note in notes:
-        pitch_class_dict[note.pitch.get_pitch_class()] += note.duration.total_beat
-    song_distribution = list(pitch_class_dict.values())
-    maj_scores = []
-    min_scores = []
-    for i in range(12):
-        maj_scores.append(scipy.stats.pearsonr(song_distribution, rotate(utils.KRUMHANSL_MAJ, i))[0])
-        min_scores.append(scipy.stats.pearsonr(song_distribution, rotate(utils.KRUMHANSL_MIN, i))[0])
-    max_score = np.argmax([maj_scores, min_scores])
-    if max_score > 11:
-        key = Key(pitch_class=KeyName(max_score - 12), scale=Scale.MINOR)
-    else:
-        key = Key(pitch_class=KeyName(max_score), scale=Scale.MAJOR)
-    return key
+    return estimate_keys([get_pitch_class_distribution(notes)])[0]
+
+
+def estimate_key_changes(notes, window=4.0, hop=1.0):
+    # Estimates the key of windows of notes by where each note starts. window and hop are in the units of
+    # start_beat, whole notes, so window=4.0 is four bars of 4/4, and window is a multiple of hop. Returns
+    # (start_beat, key) for the first window with notes and every window the key changes in. Windows without
+    # notes, e.g. during a rest, keep the key before them
+    segments = np.floor(notes.start_beat / hop).astype(int)
+    if len(segments) == 0:
+        return []
+    segment_distributions = np.zeros((np.max(segments) + 1, len(utils.PITCH_CLASSES)))
+    np.add.at(segment_distributions, (segments, notes.pitch_index % len(utils.PITCH_CLASSES)), notes.total_beat)
+    window_segments = max(1, int(round(window / hop)))
+    cumulative = np.cumsum(np.vstack([np.zeros((1, len(utils.PITCH_CLASSES))), segment_distributions]), axis=0)
+    window_ends = np.minimum(np.arange(len(segment_distributions)) + window_segments, len(segment_distributions))
+    window_distributions = cumulative[window_ends] - cumulative[:len(segment_distributions)]
+    keys = estimate_keys(window_distributions)
+    has_notes = np.sum(window_distributions, axis=1) > 0
+    key_changes = []
+    for i, key in enumerate(keys):
+        if has_notes[i] and (not key_changes or str(key) != str(key_changes[-1][1])):
+            key_changes.append((i * hop, key))
+    return key_changes
+
+
+def run_stage_graph(stages):
+    # stages maps each name to (dependencies, compute), where compute takes the results of the dependencies and
+    # dependencies are listed before the stages using them. Every stage gets a thread that waits for its
+    # dependencies, so independent stages run concurrently, NumPy and the FFTs release the GIL. Returns the
+    # results by name and raises the first error of any stage
+    futures = {}
+    with ThreadPoolExecutor(max_workers=len(stages)) as pool:
+        for name, (dependencies, compute) in stages.items():
+            dependency_futures = [futures[dependency] for dependency in dependencies]
+            futures[name] = pool.submit(lambda compute=compute, dependency_futures=dependency_futures:
+                                        compute(*[future.result() for future in dependency_futures]))
+    return {name: future.result() for name, future in futures.items()}
+
+
+def clean_piano_roll(piano_roll, tempo, onsets, note_length_threshold, onset_range, previous_note_range, instrument):
+    piano_roll = piano_roll.remove_short(get_minimum_frames(tempo, note_length_threshold))
+    piano_roll = piano_roll.smooth_onsets(onsets, onset_range=onset_range, prev_note_range=previous_note_range)
+    # Guitar notes are placed on the piano range
+    if instrument == Instrument.GUITAR:
+        piano_roll = piano_roll.pad(4, 8)
+    return piano_roll
 
 
 def notes_from_piano_roll(piano_roll, tempo):
-    notes = []
-    for i in range(np.shape(piano_roll)[0]):
-        if np.sum(piano_roll[i, :]) != 0:
-            one_mode = False
-            start_frame = None
-            for j in range(np.shape(piano_roll)[1]):
-                if piano_roll[i, j] == 1 and not one_mode:
-                    one_mode = True
-                    start_frame = j
-                if piano_roll[i, j] == 0 and one_mode:
-                    one_mode = False
-                    notes.append(
-                        Note(Pitch(name=utils.NOTE_NAME_LIST[i]),
-                             Duration(tempo=tempo, frames=(start_frame, j - start_frame))))
-                    start_frame = None
-            if one_mode:
-                notes.append(
-                    Note(Pitch(name=utils.NOTE_NAME_LIST[i]),
-                         Duration(tempo=tempo, frames=(start_frame, (np.shape(piano_roll)[1] - 1) - start_frame))))
-    return notes
+    return notes_from_runs(piano_roll.rows, piano_roll.starts, piano_roll.ends, piano_roll.shape[1], tempo)
+
+
+def notes_from_runs(rows, starts, ends, n_frames, tempo):
+    total_frames = ends - starts
+    # Notes still sounding at the end of the roll are one frame shorter
+    total_frames[ends == n_frames] -= 1
+    return NoteTable(tempo, rows, starts, total_frames)
+
+
+def transcribe_batch(tracks,
+                     plca_threshold,
+                     note_length_threshold,
+                     onset_range,
+                     previous_note_range,
+                     pre_max,
+                     post_max,
+                     instrument,
+                     time_signature,
+                     **plca_options):
+    # Transcribes many short tracks at once. Their CQTs come from one CQT call and their activations from one PLCA
+    # run, which is most of the cost of a short clip, the rest of the pipeline runs per track. See
+    # get_batch_activations for the options that give each track the activations of a transcribe of its own
+    dictionary = load_dictionary(instrument, plca_options.get('dtype'))
+    cqts = estimate_batch_cqt([track.samples for track in tracks], instrument, dtype=plca_options.get('dtype'))
+    activations = get_batch_activations(cqts, instrument.value, dictionary, **plca_options)
+    for track, cqt, (Pt, Pp_t) in zip(tracks, cqts, activations):
+        track.use_features(instrument, dictionary, cqt, Pt, Pp_t, **plca_options)
+        track.transcribe(plca_threshold, note_length_threshold, onset_range, previous_note_range, pre_max, post_max,
+                         instrument, time_signature, **plca_options)
+    return tracks
+
+
+class NoteTable:
+    # Notes stored as columns, indexing or iterating gives Note objects built on demand
+    def __init__(self, tempo, pitch_index=(), start_frames=(), total_frames=()):
+        self.tempo = tempo
+        self.pitch_index = np.asarray(pitch_index, dtype=int)
+        self.midi_number = np.asarray(utils.NOTE_MIDI_LIST)[self.pitch_index]
+        self.start_frames = np.asarray(start_frames, dtype=int)
+        self.total_frames = np.asarray(total_frames, dtype=int)
+
+    @property
+    def start_beat(self):
+        return round_to_sixteenth(0.25 * (librosa.frames_to_time(self.start_frames, sr=utils.SAMPLE_RATE)
+                                          / (60 / self.tempo)))
+
+    @property
+    def total_beat(self):
+        total_beat = round_to_sixteenth(0.25 * (librosa.frames_to_time(self.total_frames, sr=utils.SAMPLE_RATE)
+                                                / (60 / self.tempo)))
+        total_beat[total_beat == 0] = 0.0625
+        return total_beat
+
+    def __len__(self):
+        return len(self.pitch_index)
+
+    def __getitem__(self, i):
+        return Note(Pitch(name=utils.NOTE_NAME_LIST[self.pitch_index[i]]),
+                    Duration(tempo=self.tempo, frames=(self.start_frames[i], self.total_frames[i])))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
 
 
 class Track:
-    def __init__(self, tempo=None, key=None, notes=None):
+    def __init__(self, tempo=None, key=None, notes=None, feature_cache=None):
         self.tempo = tempo
         self.key = key
         if notes is None:
-            self.notes = []
+            self.notes = NoteTable(tempo)
         else:
             self.notes = notes
         self.cqt = None
@@ -65,6 +173,8 @@ class Track:
         self.display_cqt = None
         self.instrument = None
         self.time_signature = None
+        self.feature_cache = feature_cache
+        self.timings = {}
 
     def transcribe(self,
                    plca_threshold,
@@ -74,19 +184,228 @@ class Track:
                    pre_max,
                    post_max,
                    instrument,
-                   time_signature):
+                   time_signature,
+                   progress=None,
+                   cancel=None,
+                   **plca_options):
+        # Each stage is keyed by the parameters it and its upstream stages depend on, so only the stages
+        # downstream of a changed parameter are recomputed. The cache is cleared whenever the samples change.
+        # The CQT and activations are also kept in the feature cache on disk when the track has one.
+        # plca_options may set init='previous' to start PLCA from the activations of the last run on these samples,
+        # e.g. one with other plca_options, it converges in a few steps. progress is called with a stage name and
+        # the fraction of it done. A cancelled CancelToken stops the
+        # job before the next stage or PLCA step with TranscriptionCancelled, the stages already done are kept
+        # and the results of the last finished transcription are left in place
         self.instrument = instrument
-        self.tempo = int(round(estimate_tempo(self.samples)))
-        self.cqt, self.piano_roll, self.display_cqt = estimate_piano_roll(self.samples, self.tempo, plca_threshold,
-                                                                          note_length_threshold, instrument)
-        self.onsets = estimate_onset_times(self.samples, pre_max=pre_max, post_max=post_max)
-        smooth_onsets(self.piano_roll, self.onsets, onset_range=onset_range, prev_note_range=previous_note_range)
-        if instrument == Instrument.GUITAR:
-            self.piano_roll = np.pad(self.piano_roll, ((4, 8), (0, 0)))
+        self.timings = {}
+        dtype = plca_options.get('dtype')
+        dictionary = load_dictionary(instrument, dtype)
+        activations_key = self.__activations_key(instrument, dictionary, plca_options)
+        onsets_key = (pre_max, post_max)
+        piano_roll_key = activations_key + onsets_key + (plca_threshold, note_length_threshold, onset_range,
+                                                         previous_note_range)
+        activations_options = dict(plca_options)
+        if progress is not None:
+            activations_options['progress'] = lambda fraction: progress('activations', fraction)
+        if cancel is not None:
+            activations_options['cancel'] = cancel
+
+        # The job keeps the samples and stage cache it starts with, see __stage
+        samples = self.samples
+        audio = (samples, self.__stages)
+
+        def stage(name, key, compute, persistent=False):
+            if cancel is not None:
+                cancel.check()
+            value = self.__stage(name, key, compute, persistent, audio)
+            if progress is not None:
+                progress(name, 1.0)
+            return value
+
+        def onset_envelope():
+            return stage('onset_envelope', (), lambda: estimate_onset_envelope(samples))
+
+        def tempo(envelope):
+            return stage('tempo', (),
+                         lambda: int(round(estimate_tempo(samples, onset_envelope=envelope))))
+
+        def onsets(envelope):
+            return stage('onsets', onsets_key,
+                         lambda: estimate_onset_times(samples, pre_max=pre_max, post_max=post_max,
+                                                      onset_envelope=envelope))
+
+        def cqt():
+            return stage('cqt', self.__cqt_key(instrument, dtype),
+                         lambda: (estimate_cqt(samples, instrument, dtype=dtype),), persistent=True)[0]
+
+        def activations(cqt):
+            options = activations_options
+            if isinstance(options.get('init'), str) and options['init'] == 'previous':
+                options = dict(options, init=self.__previous_activations(audio, instrument, cqt))
+            return stage('activations', activations_key,
+                         lambda: get_activations(cqt, instrument.value, dictionary, **options), persistent=True)
+
+        def piano_roll(activations, tempo, onsets):
+            return stage('piano_roll', piano_roll_key,
+                         lambda: clean_piano_roll(PianoRoll.from_activations(*activations, plca_threshold),
+                                                  tempo, onsets, note_length_threshold, onset_range,
+                                                  previous_note_range, instrument))
+
+        def notes(piano_roll, tempo):
+            return stage('notes', piano_roll_key, lambda: notes_from_piano_roll(piano_roll, tempo))
+
+        def key(notes):
+            return stage('key', piano_roll_key, lambda: estimate_key(notes))
+
+        # Tempo and onsets only depend on the samples, so they run alongside the CQT and PLCA
+        results = run_stage_graph({
+            'onset_envelope': ((), onset_envelope),
+            'tempo': (('onset_envelope',), tempo),
+            'onsets': (('onset_envelope',), onsets),
+            'cqt': ((), cqt),
+            'activations': (('cqt',), activations),
+            'piano_roll': (('activations', 'tempo', 'onsets'), piano_roll),
+            'notes': (('piano_roll', 'tempo'), notes),
+            'key': (('notes',), key),
+        })
+        self.tempo = results['tempo']
+        self.onsets = results['onsets']
+        self.cqt = results['cqt']
+        self.piano_roll = results['piano_roll']
+        self.notes = results['notes']
+        self.key = results['key']
+        self.time_signature = time_signature
+
+    def transcribe_stream(self,
+                          path,
+                          plca_threshold,
+                          note_length_threshold,
+                          onset_range,
+                          previous_note_range,
+                          pre_max,
+                          post_max,
+                          instrument,
+                          time_signature,
+                          block_frames=4096,
+                          progress=None,
+                          cancel=None,
+                          **plca_options):
+        # Transcribes a wav file without loading it, memory is bounded by the block size and the number of notes.
+        # Post processing works on note runs, so no samples, CQT or dense piano roll are kept. progress and cancel
+        # work as in transcribe, the blocks are reported as the 'stream' stage
+        self.samples = None
+        self.cqt = None
+        self.instrument = instrument
+        stream_progress = None
+        if progress is not None:
+            stream_progress = lambda fraction: progress('stream', fraction)
+        start = time.perf_counter()
+        with open_wav(path) as wav_file:
+            n_frames = 1 + wav_file.frames // utils.HOP_LENGTH
+            rows, starts, ends, onset_envelope = stream_activation_runs(wav_file, plca_threshold, instrument,
+                                                                        block_frames=block_frames,
+                                                                        progress=stream_progress, cancel=cancel,
+                                                                        **plca_options)
+        self.timings = {'stream': time.perf_counter() - start}
+        start = time.perf_counter()
+        self.tempo = int(round(estimate_tempo(None, onset_envelope=onset_envelope)))
+        self.onsets = estimate_onset_times(None, pre_max=pre_max, post_max=post_max, onset_envelope=onset_envelope)
+        self.piano_roll = clean_piano_roll(PianoRoll(rows, starts, ends, (instrument.value, n_frames)), self.tempo,
+                                           self.onsets, note_length_threshold, onset_range, previous_note_range,
+                                           instrument)
         self.notes = notes_from_piano_roll(self.piano_roll, self.tempo)
         self.key = estimate_key(self.notes)
+        self.timings['notes'] = time.perf_counter() - start
         self.time_signature = time_signature
 
+    def use_features(self, instrument, dictionary, cqt, Pt, Pp_t, **plca_options):
+        # Hands the track a CQT and activations computed elsewhere, e.g. by transcribe_batch. A following
+        # transcribe with the same instrument and plca_options uses them instead of running its own
+        self.__stages['cqt'] = (self.__cqt_key(instrument, plca_options.get('dtype')), (cqt,))
+        self.__stages['activations'] = (self.__activations_key(instrument, dictionary, plca_options), (Pt, Pp_t))
+
+    def __cqt_key(self, instrument, dtype):
+        if dtype is None:
+            return (instrument,)
+        return (instrument, np.dtype(dtype).name)
+
+    def __activations_key(self, instrument, dictionary, plca_options):
+        # Arrays, e.g. an explicit init, are keyed by their hash, they can not be compared with == and their repr
+        # in the feature cache key is truncated
+        return (instrument, hash_array(dictionary)) + tuple(
+            (name, hash_array(value) if isinstance(value, np.ndarray) else value)
+            for name, value in sorted(plca_options.items()))
+
+    def __previous_activations(self, audio, instrument, cqt):
+        # Falls back to a projection of the CQT when there is no earlier run of the same shape
+        previous = audio[1].get('activations')
+        if previous is None or np.shape(previous[1][1]) != (instrument.value, np.shape(cqt)[1]):
+            return 'projection'
+        return previous[1][1]
+
+    def __stage(self, name, key, compute, persistent=False, audio=None):
+        # Seconds spent in each stage are kept in timings, a stage still valid from the last run takes none.
+        # audio is the samples and stage cache a job started with, so a job superseded by new samples can not
+        # store its stages in the cache of the new ones
+        if audio is None:
+            audio = (self.samples, self.__stages)
+        stages = audio[1]
+        start = time.perf_counter()
+        if name in stages and stages[name][0] == key:
+            value = stages[name][1]
+        elif persistent and self.feature_cache is not None:
+            value = self.__cached(audio, name, key, compute)
+        else:
+            value = compute()
+        stages[name] = (key, value)
+        self.timings[name] = time.perf_counter() - start
+        return value
+
+    def __cached(self, audio, name, key, compute):
+        # Persistent stages return a tuple of arrays, stored under the stage, the audio and the stage key
+        samples, stages = audio
+        if 'audio_hash' not in stages:
+            stages['audio_hash'] = ((), hash_array(samples))
+        cache_key = self.feature_cache.key(name, stages['audio_hash'][1], key)
+        arrays = self.feature_cache.load(cache_key)
+        if arrays is None:
+            arrays = compute()
+            self.feature_cache.store(cache_key, arrays)
+        return tuple(arrays)
+
+    @property
+    def samples(self):
+        return self.__samples
+
+    @property
+    def display_cqt(self):
+        # The display CQT is only needed by the CQT view, so it is computed on first use and kept until the
+        # samples change. It is slow, so a GUI reads it on a worker thread, see has_display_cqt. A result for
+        # samples replaced while it was computed is returned but not kept
+        audio = (self.samples, self.__stages)
+        if self.__display_cqt is None and audio[0] is not None:
+            display_cqt, = self.__stage('display_cqt', (), lambda: (estimate_display_cqt(audio[0]),),
+                                        persistent=True, audio=audio)
+            if self.samples is audio[0]:
+                self.__display_cqt = display_cqt
+            return display_cqt
+        return self.__display_cqt
+
+    @property
+    def has_display_cqt(self):
+        # Whether display_cqt can be read without computing it
+        return self.__display_cqt is not None or self.samples is None
+
+    @samples.setter
+    def samples(self, value):
+        self.__samples = value
+        self.__display_cqt = None
+        self.__stages = {}
+
+    @display_cqt.setter
+    def display_cqt(self, value):
+        self.__display_cqt = value
+
     def to_midi_file(self, file):
         midi = MIDIFile(1)
         midi.addTempo(0, 0, self.tempo)
@@ -101,9 +420,9 @@ class Track:
             accidental_type = midiutil.FLATS
         midi.addKeySignature(0, 0, self.key.get_circle_of_fifths()[0], accidental_type, mode)
 
-        for note in self.notes:
-            midi.addNote(0, 0, note.pitch.midi_number, note.duration.start_beat * 4, note.duration.total_beat * 4,
-                         utils.MIDI_VOLUME)
+        for midi_number, start_beat, total_beat in zip(self.notes.midi_number, self.notes.start_beat,
+                                                       self.notes.total_beat):
+            midi.addNote(0, 0, midi_number, start_beat * 4, total_beat * 4, utils.MIDI_VOLUME)
         with open(file, "wb") as output_file:
             midi.writeFile(output_file)
 
@@ -0,0 +1,23 @@
+import threading
+
+
+class TranscriptionCancelled(Exception):
+    pass
+
+
+class CancelToken:
+    # Shared by whoever starts a job and the job itself. cancel may be called from any thread, the job calls check
+    # between steps and stops there with TranscriptionCancelled
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise TranscriptionCancelled('Transcription was cancelled')
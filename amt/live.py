@@ -0,0 +1,138 @@
+import time
+
+import numpy as np
+import librosa
+
+from amt import utils
+from amt.utils import get_activations, threshold_dynamics, load_dictionary, get_cqt_fmin, Instrument
+
+LATENCY_BINS_MS = np.arange(0, 205, 5)
+
+
+def get_live_kernel(instrument, lookahead_frames):
+    # Time domain filters giving the same magnitudes as estimate_cqt for one frame at a time. Filters of low notes
+    # reach further ahead than the lookahead, they are cut off at the newest sample and rescaled so a steady tone
+    # keeps its magnitude
+    freqs = librosa.cqt_frequencies(instrument.value, fmin=get_cqt_fmin(instrument), bins_per_octave=12)
+    filters, lengths = librosa.filters.wavelet(freqs=freqs, sr=utils.SAMPLE_RATE, norm=1)
+    centre = np.shape(filters)[1] // 2
+    kept = filters[:, :min(centre + lookahead_frames * utils.HOP_LENGTH + 1, np.shape(filters)[1])]
+    gain = np.sum(np.abs(filters), axis=1) / np.sum(np.abs(kept), axis=1)
+    return kept * (np.sqrt(lengths) * gain)[:, np.newaxis].astype(np.float32), centre
+
+
+def get_warm_start(last_activations, dictionary, cqt):
+    # The activations of the last frame for every new frame, plus the new frames projected on the dictionary so
+    # notes starting in them are not held back. Each part sums to one per frame
+    tiny = np.finfo(cqt.dtype).tiny
+    projection = dictionary.T @ cqt
+    projection /= np.maximum(np.sum(projection, axis=0), tiny)
+    return projection + (last_activations / max(np.sum(last_activations), tiny))[:, np.newaxis]
+
+
+class NoteEvent:
+    def __init__(self, kind, midi_number, frame):
+        self.kind = kind
+        self.midi_number = midi_number
+        self.frame = frame
+
+    @property
+    def time(self):
+        return self.frame * utils.TIME_PER_FRAME
+
+    def __str__(self):
+        return '{} {} at {:.3f}s'.format(self.kind, self.midi_number, self.time)
+
+
+class LiveTranscriber:
+    # Transcribes an audio stream while it is recorded. Samples are pushed in blocks of any size and every frame is
+    # transcribed once, as soon as lookahead_frames of audio after it have arrived. PLCA runs on the new frames
+    # only, which gives the same activations as a whole recording would since the dictionary is fixed. A note on
+    # is reported once a pitch has been active for min_frames frames. Only the samples the CQT filters need and the
+    # last history_frames frames of the piano roll are kept. With warm_start PLCA starts the new frames from the
+    # activations of the last frame, see get_warm_start. With method='active' those frames converge in fewer steps
+    def __init__(self, instrument=Instrument.PIANO, plca_threshold=0.1, lookahead_frames=4, min_frames=1,
+                 history_frames=512, warm_start=True, **plca_options):
+        self.instrument = instrument
+        self.warm_start = warm_start
+        self.last_activations = None
+        self.plca_threshold = plca_threshold
+        self.lookahead = lookahead_frames * utils.HOP_LENGTH
+        self.min_frames = min_frames
+        self.plca_options = dict({'progress_step': None}, **plca_options)
+        self.kernel, self.past = get_live_kernel(instrument, lookahead_frames)
+        self.dictionary = load_dictionary(instrument, np.float32)
+        # The stream starts with silence, like the padding of a centred CQT
+        self.buffer = np.zeros(self.past, dtype=np.float32)
+        self.buffer_start = -self.past
+        self.received = 0
+        self.frame = 0
+        self.run_lengths = np.zeros(instrument.value, dtype=int)
+        self.sounding = np.zeros(instrument.value, dtype=bool)
+        self.roll = np.zeros((instrument.value, history_frames), dtype=bool)
+        self.latencies = []
+
+    def push(self, samples, arrival_time=None):
+        # arrival_time is when the last of the samples was recorded, on the time.perf_counter clock
+        if arrival_time is None:
+            arrival_time = time.perf_counter()
+        self.buffer = np.concatenate((self.buffer, np.ravel(samples).astype(np.float32)))
+        self.received += np.size(samples)
+        last_frame = (self.received - self.lookahead - 1) // utils.HOP_LENGTH
+        if last_frame < self.frame:
+            return []
+        frames = np.arange(self.frame, last_frame + 1)
+        windows = np.lib.stride_tricks.sliding_window_view(self.buffer, np.shape(self.kernel)[1])
+        cqt = np.abs(self.kernel @ windows[frames * utils.HOP_LENGTH - self.past - self.buffer_start].T)
+        plca_options = self.plca_options
+        if self.warm_start and self.last_activations is not None:
+            plca_options = dict(plca_options, init=get_warm_start(self.last_activations, self.dictionary, cqt))
+        Pt, Pp_t = get_activations(cqt, self.instrument.value, self.dictionary, **plca_options)
+        self.last_activations = Pp_t[:, -1]
+        events = self.update(threshold_dynamics(Pt, Pp_t, self.plca_threshold) == 1)
+        # A frame is heard when the sample at its centre is recorded
+        heard = arrival_time - (self.received - frames * utils.HOP_LENGTH) / utils.SAMPLE_RATE
+        self.latencies.extend(time.perf_counter() - heard)
+        self.frame = last_frame + 1
+        # Keep the samples the next frame starts from
+        drop = self.frame * utils.HOP_LENGTH - self.past - self.buffer_start
+        self.buffer = self.buffer[drop:]
+        self.buffer_start += drop
+        return events
+
+    def update(self, active):
+        events = []
+        for i in range(np.shape(active)[1]):
+            frame = self.frame + i
+            self.run_lengths = np.where(active[:, i], self.run_lengths + 1, 0)
+            started = self.run_lengths == self.min_frames
+            stopped = self.sounding & ~active[:, i]
+            self.sounding = (self.sounding | started) & active[:, i]
+            for pitch in np.flatnonzero(stopped):
+                events.append(NoteEvent('note_off', utils.NOTE_MIDI_LIST[pitch], frame))
+            for pitch in np.flatnonzero(started):
+                events.append(NoteEvent('note_on', utils.NOTE_MIDI_LIST[pitch], frame - self.min_frames + 1))
+            self.roll[:, frame % np.shape(self.roll)[1]] = active[:, i]
+        return events
+
+    def finish(self):
+        # Transcribes the last frames against silence and ends every sounding note after them
+        events = self.push(np.zeros(self.lookahead, dtype=np.float32))
+        events += [NoteEvent('note_off', utils.NOTE_MIDI_LIST[pitch], self.frame)
+                   for pitch in np.flatnonzero(self.sounding)]
+        self.sounding[:] = False
+        self.run_lengths[:] = 0
+        return events
+
+    @property
+    def piano_roll(self):
+        # The last history_frames frames, oldest first
+        return np.roll(self.roll, -(self.frame % np.shape(self.roll)[1]), axis=1)
+
+    def latency_histogram(self, bins=LATENCY_BINS_MS):
+        return np.histogram(np.array(self.latencies) * 1000, bins=bins)
+
+    def latency_percentile(self, q):
+        if not self.latencies:
+            return None
+        return np.percentile(self.latencies, q) * 1000
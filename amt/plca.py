@@ -1,18 +1,129 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import os
+
 import numpy as np
 
+DEFAULT_MEMORY_BUDGET = 64 * 2 ** 20
+INIT_FLOOR = 1e-6
+
 
 def reconstruct(Pt, Pomega_p, Pp_t, omegan, tn):
-    Pomega_t = np.zeros((omegan, tn))
-    for i in range(tn):
-        Pomega_t[:, i] = np.sum(Pomega_p * Pp_t[:, i], axis=1)
-    return Pt * Pomega_t
+    return Pt * (Pomega_p @ Pp_t)
 
 
 def cross_entropy(U, V):
-    return -np.sum(U * np.log(V))
+    # Frames are summed in float64 so the convergence test still resolves small improvements in float32
+    return -np.sum(np.sum(U * np.log(V), axis=0), dtype=np.float64)
+
+
+def init_activations(pn, tn, dtype, init=None):
+    # Random activations from np.random, or a copy of init as the engines update the activations in place
+    if init is None:
+        Pp_t = np.random.rand(pn, tn).astype(dtype, copy=False)
+        Pp_t /= np.sum(Pp_t, axis=0).reshape(1, -1)
+        return Pp_t
+    if np.shape(init) != (pn, tn):
+        raise Exception("Initial activations have shape {}, expected {}".format(np.shape(init), (pn, tn)))
+    return np.array(init, dtype=dtype)
+
+
+def get_initial_activations(V, pn, Pomega_p, init=None, seed=None, segments=None):
+    # init is 'random', 'projection' for the magnitudes projected on the dictionary, or an array of activations,
+    # e.g. those of a previous run on the same or neighbouring frames. Random activations come from np.random
+    # unless a seed is given, None is returned for those so each engine draws them as it always has. segments are
+    # the frame counts of clips laid side by side in V, each draws its seeded start as if it were run alone.
+    # Projected and given activations are normalised per frame and floored, EM can not bring back a pitch that
+    # starts at zero, silent frames start uniform
+    tn = np.shape(V)[1]
+    if init is None or isinstance(init, str) and init == 'random':
+        if seed is None:
+            return None
+        if segments is None:
+            segments = [tn]
+        Pp_t = np.hstack([np.random.default_rng(seed).random((pn, segment)).astype(V.dtype, copy=False)
+                          for segment in segments])
+        return Pp_t / np.sum(Pp_t, axis=0)
+    if isinstance(init, str):
+        if init != 'projection':
+            raise Exception("PLCA init {} does not exist".format(init))
+        Pp_t = Pomega_p.T @ V
+    else:
+        Pp_t = init_activations(pn, tn, V.dtype, init)
+    frame_sums = np.sum(Pp_t, axis=0)
+    Pp_t = Pp_t / np.where(frame_sums > 0, frame_sums, 1) + INIT_FLOOR / pn
+    return Pp_t / np.sum(Pp_t, axis=0)
+
+
+def flush_denormals(Pp_t):
+    # Activations of absent pitches shrink geometrically and in float32 soon reach denormal values, which are
+    # many times slower to compute with. They are set to zero, where they were heading. float64 never gets there
+    if Pp_t.dtype == np.float32:
+        Pp_t[Pp_t < np.finfo(np.float32).tiny] = 0
+    return Pp_t
+
+
+def get_block_size(omegan, pn, memory_budget, itemsize=8):
+    # Working arrays held per frame of a block: model spectrum, ratio, reconstruction and its log (omegan each),
+    # plus the activation update and the block copy of Pp_t (pn each)
+    return max(1, int(memory_budget // ((4 * omegan + 2 * pn) * itemsize)))
+
+
+def get_time_blocks(tn, block_size):
+    return [slice(i, min(i + block_size, tn)) for i in range(0, tn, block_size)]
+
+
+def blocked_cross_entropy(V, Pt, Pomega_p, Pp_t, blocks):
+    return sum(cross_entropy(V[:, block], Pt[block] * (Pomega_p @ Pp_t[:, block])) for block in blocks)
+
 
+def em_block(V, V_t, Pt, Pomega_p, Pp_t, block):
+    # Updates Pp_t in place for the frames in block and returns the cross entropy of those frames afterwards
+    Pp_t[:, block] *= Pomega_p.T @ (V[:, block] / (Pomega_p @ Pp_t[:, block]))
+    Pp_t[:, block] /= V_t[block]
+    flush_denormals(Pp_t[:, block])
+    return cross_entropy(V[:, block], Pt[block] * (Pomega_p @ Pp_t[:, block]))
 
-def plca(Vo, pn, Pomega_p, maxstep=100, progress_step=50):
+
+def em_update(V, V_t, Pomega_p, Pp_t):
+    return flush_denormals(Pp_t * (Pomega_p.T @ (V / (Pomega_p @ Pp_t))) / V_t)
+
+
+def frame_cross_entropy(V, Pt, Pomega_p, Pp_t):
+    return -np.sum(V * np.log(Pt * (Pomega_p @ Pp_t)), axis=0)
+
+
+def get_step_callback(maxstep, progress, cancel):
+    # progress is called with the fraction of maxstep done, a run that converges early jumps to the end
+    if progress is None and cancel is None:
+        return None
+
+    def on_step(step):
+        if cancel is not None:
+            cancel.check()
+        if progress is not None:
+            progress(min(step + 1, maxstep) / maxstep)
+    return on_step
+
+
+def plca(Vo, pn, Pomega_p, maxstep=100, progress_step=50, method='matrix', dtype=None, progress=None, cancel=None,
+         init=None, seed=None, segments=None, **options):
+    # A progress_step of None turns the progress output off. dtype is the precision PLCA works in, by default that
+    # of the magnitudes of Vo. The dictionary is brought to it once here so no update upcasts, except in the loop
+    # method which is kept as the float64 reference. progress and the CancelToken cancel are checked every step.
+    # init, seed and segments choose the initial activations, see get_initial_activations
+    if method not in PLCA_METHODS:
+        raise Exception("PLCA method {} does not exist".format(method))
+    V = np.abs(Vo)
+    if dtype is not None:
+        V = V.astype(dtype, copy=False)
+    Pomega_p = np.asarray(Pomega_p, dtype=V.dtype)
+    return PLCA_METHODS[method](V, pn, Pomega_p, maxstep=maxstep, progress_step=progress_step,
+                                on_step=get_step_callback(maxstep, progress, cancel),
+                                init=get_initial_activations(V, pn, Pomega_p, init, seed, segments), **options)
+
+
+def plca_loop(Vo, pn, Pomega_p, maxstep=100, progress_step=50, on_step=None, init=None):
     eps = 1e-8
     step = 0
 
@@ -21,8 +132,7 @@ def plca(Vo, pn, Pomega_p, maxstep=100, progress_step=50):
     V = V / np.sum(V)
     omegan, tn = np.shape(V)
 
-    Pp_t = np.random.rand(pn, tn)
-    Pp_t /= np.sum(Pp_t, axis=0).reshape(1, -1)
+    Pp_t = init_activations(pn, tn, np.float64, init)
 
     oldentropy = cross_entropy(V, reconstruct(Pt, Pomega_p, Pp_t, omegan, tn))
 
@@ -44,10 +154,244 @@ def plca(Vo, pn, Pomega_p, maxstep=100, progress_step=50):
         if step > maxstep or (0 < impr < eps):
             break
         else:
-            if step % progress_step == 0:
+            if progress_step and step % progress_step == 0:
                 print('Step %d: Entropy = %e, D(Entropy) = %e.\n' % (step, entropy, impr))
+            if on_step is not None:
+                on_step(step)
             oldentropy = entropy
 
         step += 1
 
     return Pt, Pp_t
+
+
+def plca_matrix(Vo, pn, Pomega_p, maxstep=100, progress_step=50, on_step=None, init=None):
+    eps = 1e-8
+    step = 0
+
+    V = np.abs(Vo)
+    Pt = np.sum(V, axis=0)
+    V = V / np.sum(V)
+    V_t = np.sum(V, axis=0)
+
+    Pp_t = init_activations(pn, np.shape(V)[1], V.dtype, init)
+
+    # Pomega_t is the model spectrum for the current activations, it is reused
+    # as the E step normaliser of the next iteration
+    Pomega_t = Pomega_p @ Pp_t
+    oldentropy = cross_entropy(V, Pt * Pomega_t)
+
+    while True:
+        # E and M Step, sum_omega V * Pomega_p * Pp_t / Pomega_t without building the posterior
+        Pp_t *= Pomega_p.T @ (V / Pomega_t)
+        Pp_t /= V_t
+        flush_denormals(Pp_t)
+
+        Pomega_t = Pomega_p @ Pp_t
+        entropy = cross_entropy(V, Pt * Pomega_t)
+
+        impr = oldentropy - entropy
+        if step > maxstep or (0 < impr < eps):
+            break
+        else:
+            if progress_step and step % progress_step == 0:
+                print('Step %d: Entropy = %e, D(Entropy) = %e.\n' % (step, entropy, impr))
+            if on_step is not None:
+                on_step(step)
+            oldentropy = entropy
+
+        step += 1
+
+    return Pt, Pp_t
+
+
+def plca_blocked(Vo, pn, Pomega_p, maxstep=100, progress_step=50, memory_budget=DEFAULT_MEMORY_BUDGET, workers=1,
+                 on_step=None, init=None):
+    eps = 1e-8
+    step = 0
+
+    # Only V and Pp_t span the whole recording, every other temporary is limited to one block of frames. Vo is
+    # normalised in place rather than copied, so it must be a real array the caller no longer needs. plca passes
+    # its own array of magnitudes, the engine is meant to be reached through it
+    V = Vo
+    Pt = np.sum(V, axis=0)
+    V /= np.sum(V)
+    V_t = np.sum(V, axis=0)
+    omegan, tn = np.shape(V)
+    # Each worker holds one block of temporaries at a time, and every worker needs at least one block
+    block_size = min(get_block_size(omegan, pn, memory_budget // workers, V.itemsize), -(-tn // workers))
+    blocks = get_time_blocks(tn, block_size)
+
+    Pp_t = init_activations(pn, tn, V.dtype, init)
+
+    oldentropy = blocked_cross_entropy(V, Pt, Pomega_p, Pp_t, blocks)
+
+    # Frames only interact through the convergence test, so blocks are updated concurrently and their
+    # entropies summed in block order, giving the same result for any number of workers
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        update = partial(em_block, V, V_t, Pt, Pomega_p, Pp_t)
+        while True:
+            entropy = sum(pool.map(update, blocks))
+
+            impr = oldentropy - entropy
+            if step > maxstep or (0 < impr < eps):
+                break
+            else:
+                if progress_step and step % progress_step == 0:
+                    print('Step %d: Entropy = %e, D(Entropy) = %e.\n' % (step, entropy, impr))
+                if on_step is not None:
+                    on_step(step)
+                oldentropy = entropy
+
+            step += 1
+
+    return Pt, Pp_t
+
+
+def plca_parallel(Vo, pn, Pomega_p, maxstep=100, progress_step=50, memory_budget=DEFAULT_MEMORY_BUDGET,
+                  workers=None, on_step=None, init=None):
+    # Vo is normalised in place, see plca_blocked
+    if workers is None:
+        workers = os.cpu_count() or 1
+    return plca_blocked(Vo, pn, Pomega_p, maxstep=maxstep, progress_step=progress_step, memory_budget=memory_budget,
+                        workers=workers, on_step=on_step, init=init)
+
+
+def plca_active(Vo, pn, Pomega_p, maxstep=100, progress_step=50, frame_tol=1e-4, return_steps=False,
+                on_step=None, init=None):
+    step = 0
+
+    V = np.abs(Vo)
+    Pt = np.sum(V, axis=0)
+    V = V / np.sum(V)
+    V_t = np.sum(V, axis=0)
+    tn = np.shape(V)[1]
+
+    Pp_t = init_activations(pn, tn, V.dtype, init)
+
+    # Frames still being updated, silent frames carry no information and are never active. The arrays below are
+    # compacted to the active frames so converged frames cost nothing in later iterations
+    frame_steps = np.zeros(tn, dtype=int)
+    active = np.flatnonzero(V_t > 0)
+    Va = V[:, active]
+    Pt_a = Pt[active]
+    V_ta = V_t[active]
+    Pp_a = Pp_t[:, active]
+
+    Pomega_t = Pomega_p @ Pp_a
+    oldentropy = -np.sum(Va * np.log(Pt_a * Pomega_t), axis=0)
+    done = np.zeros(active.size, dtype=bool)
+
+    while active.size > 0:
+        Pp_a *= Pomega_p.T @ (Va / Pomega_t)
+        Pp_a /= V_ta
+        flush_denormals(Pp_a)
+
+        Pomega_t = Pomega_p @ Pp_a
+        entropy = -np.sum(Va * np.log(Pt_a * Pomega_t), axis=0)
+        frame_steps[active] += 1
+
+        # A frame has converged once its cross entropy improves by less than frame_tol relative to its magnitude,
+        # loud frames have a negative cross entropy as Pt * Pomega_t exceeds one there.
+        # Converged frames are dropped in batches, as compacting the arrays every step costs more than it saves
+        done |= (oldentropy - entropy) < frame_tol * np.abs(entropy)
+        if step > maxstep or np.all(done):
+            Pp_t[:, active] = Pp_a
+            break
+        else:
+            if progress_step and step % progress_step == 0:
+                print('Step %d: Entropy = %e, Active frames = %d.\n' % (step, np.sum(entropy), active.size))
+            if on_step is not None:
+                on_step(step)
+            oldentropy = entropy
+            if np.count_nonzero(done) > active.size // 8:
+                Pp_t[:, active[done]] = Pp_a[:, done]
+                keep = ~done
+                active = active[keep]
+                Va = Va[:, keep]
+                Pt_a = Pt_a[keep]
+                V_ta = V_ta[keep]
+                Pp_a = Pp_a[:, keep]
+                Pomega_t = Pomega_t[:, keep]
+                oldentropy = oldentropy[keep]
+                done = done[keep]
+
+        step += 1
+
+    if progress_step:
+        print('Active set: %d of %d frames updated, %.1f steps per frame on average.\n'
+              % (np.count_nonzero(frame_steps), tn, np.mean(frame_steps)))
+
+    if return_steps:
+        return Pt, Pp_t, frame_steps
+    return Pt, Pp_t
+
+
+def plca_squarem(Vo, pn, Pomega_p, maxstep=100, progress_step=50, on_step=None, init=None):
+    eps = 1e-8
+    step = 0
+
+    V = np.abs(Vo)
+    tiny = np.finfo(V.dtype).tiny
+    Pt = np.sum(V, axis=0)
+    V = V / np.sum(V)
+    V_t = np.sum(V, axis=0)
+
+    Pp_t = init_activations(pn, np.shape(V)[1], V.dtype, init)
+
+    oldentropy = np.sum(frame_cross_entropy(V, Pt, Pomega_p, Pp_t), dtype=np.float64)
+
+    # SQUAREM, each cycle takes two EM steps and extrapolates along them with a step length chosen per frame.
+    # The step is halved towards plain EM until the activations stay non-negative, then a third EM step
+    # stabilises the result. Frames that end up worse than plain EM fall back to it, so the cross entropy never
+    # increases. step counts EM updates so maxstep is comparable with the other engines
+    while True:
+        Pp_1 = em_update(V, V_t, Pomega_p, Pp_t)
+        Pp_2 = em_update(V, V_t, Pomega_p, Pp_1)
+        r = Pp_1 - Pp_t
+        v = Pp_2 - Pp_1 - r
+        alpha = np.minimum(-np.sqrt(np.sum(r ** 2, axis=0) / np.maximum(np.sum(v ** 2, axis=0), tiny)), -1)
+
+        Pp_x = Pp_t - 2 * alpha * r + alpha ** 2 * v
+        for _ in range(10):
+            negative = np.any(Pp_x < 0, axis=0)
+            if not np.any(negative):
+                break
+            alpha[negative] = (alpha[negative] - 1) / 2
+            Pp_x[:, negative] = (Pp_t[:, negative] - 2 * alpha[negative] * r[:, negative]
+                                 + alpha[negative] ** 2 * v[:, negative])
+        negative = np.any(Pp_x < 0, axis=0)
+        Pp_x[:, negative] = Pp_2[:, negative]
+        Pp_x /= np.sum(Pp_x, axis=0)
+        Pp_t = em_update(V, V_t, Pomega_p, Pp_x)
+
+        frame_entropy = frame_cross_entropy(V, Pt, Pomega_p, Pp_t)
+        frame_entropy_2 = frame_cross_entropy(V, Pt, Pomega_p, Pp_2)
+        fallback = ~(frame_entropy <= frame_entropy_2)
+        Pp_t[:, fallback] = Pp_2[:, fallback]
+        frame_entropy[fallback] = frame_entropy_2[fallback]
+        entropy = np.sum(frame_entropy, dtype=np.float64)
+
+        impr = oldentropy - entropy
+        if step > maxstep or (0 < impr < eps):
+            break
+        else:
+            if progress_step and step % progress_step < 3:
+                print('Step %d: Entropy = %e, D(Entropy) = %e.\n' % (step, entropy, impr))
+            if on_step is not None:
+                on_step(step)
+            oldentropy = entropy
+
+        step += 3
+
+    return Pt, Pp_t
+
+
+PLCA_METHODS = {
+    'loop': plca_loop,
+    'matrix': plca_matrix,
+    'blocked': plca_blocked,
+    'parallel': plca_parallel,
+    'active': plca_active,
+    'squarem': plca_squarem
+}
@@ -0,0 +1,83 @@
+import os
+import tempfile
+
+import numpy as np
+from soundfile import SoundFile
+
+from amt import utils
+
+DEFAULT_RING_SECONDS = 10
+
+
+class RingBuffer:
+    # Preallocated ring of float32 samples for one producer and one consumer thread. The producer only moves
+    # written and the consumer only moves read, each after its copy is done, so neither needs a lock. Samples that
+    # do not fit are dropped and counted
+    def __init__(self, capacity):
+        self.data = np.zeros(capacity, dtype=np.float32)
+        self.written = 0
+        self.read = 0
+        self.dropped = 0
+
+    def write(self, samples):
+        samples = np.ravel(samples)
+        free = len(self.data) - (self.written - self.read)
+        if np.size(samples) > free:
+            self.dropped += np.size(samples) - free
+            samples = samples[:free]
+        start = self.written % len(self.data)
+        first = min(np.size(samples), len(self.data) - start)
+        self.data[start:start + first] = samples[:first]
+        self.data[:np.size(samples) - first] = samples[first:]
+        self.written += np.size(samples)
+
+    def read_available(self):
+        # Returns up to two views of the unread samples in order, release must be called once they are used
+        start = self.read % len(self.data)
+        available = self.written - self.read
+        first = min(available, len(self.data) - start)
+        return self.data[start:start + first], self.data[:available - first]
+
+    def release(self, count):
+        self.read += count
+
+
+class Recorder:
+    # Records through a ring buffer. The audio callback only copies into the ring, drain moves the samples to a
+    # raw float32 file, and to a PCM-24 wav file when wav_path is given, so memory stays constant however long
+    # the recording is. close returns the recording as a read only memory map of the raw file
+    def __init__(self, ring_seconds=DEFAULT_RING_SECONDS, wav_path=None, directory=None):
+        self.ring = RingBuffer(int(ring_seconds * utils.SAMPLE_RATE))
+        descriptor, self.path = tempfile.mkstemp(prefix='amt-recording-', suffix='.f32', dir=directory)
+        self.raw_file = os.fdopen(descriptor, 'wb')
+        self.wav_file = None
+        if wav_path is not None:
+            self.wav_file = SoundFile(wav_path, mode='w', samplerate=utils.SAMPLE_RATE, channels=utils.CHANNELS,
+                                      subtype=utils.SUBTYPE)
+        self.length = 0
+
+    def callback(self, indata, frames, time, status):
+        self.ring.write(indata)
+
+    def drain(self):
+        count = 0
+        for samples in self.ring.read_available():
+            self.raw_file.write(samples.tobytes())
+            if self.wav_file is not None:
+                self.wav_file.write(samples)
+            count += len(samples)
+        self.ring.release(count)
+        self.length += count
+        return count
+
+    def close(self):
+        self.drain()
+        self.raw_file.close()
+        if self.wav_file is not None:
+            self.wav_file.close()
+        if self.ring.dropped:
+            print('Recording dropped %d samples, the ring buffer was full.' % self.ring.dropped)
+        # An empty file can not be memory mapped
+        if self.length == 0:
+            return np.zeros(0, dtype=np.float32)
+        return np.memmap(self.path, dtype=np.float32, mode='r', shape=(self.length,))
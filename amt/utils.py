@@ -1,5 +1,7 @@
 from soundfile import SoundFile
 import numpy as np
+import os
+import threading
 import librosa
 import librosa.display
 import matplotlib.pyplot as plt
@@ -14,13 +16,21 @@ HOP_LENGTH = 512
 TIME_PER_FRAME = HOP_LENGTH / SAMPLE_RATE
 PITCH_CLASSES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
 NOTE_FREQ_LIST = [2 ** (i / 12) * 440 for i in range(-33, 27)]
-NOTE_NAME_LIST = librosa.hz_to_note(NOTE_FREQ_LIST)
-NOTE_MIDI_LIST = librosa.note_to_midi(NOTE_NAME_LIST)
+# Newer librosa returns arrays, Pitch looks notes up with list.index
+NOTE_NAME_LIST = list(librosa.hz_to_note(NOTE_FREQ_LIST))
+NOTE_MIDI_LIST = list(librosa.note_to_midi(NOTE_NAME_LIST))
 KRUMHANSL_MAJ = [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88]
 KRUMHANSL_MIN = [6.33, 2.68, 3.52, 5.38, 2.6, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
 MIDI_VOLUME = 100
-PIANO_DICT_PATH = 'dictionaries/piano_dictionary.npy'
-GUITAR_DICT_PATH = 'dictionaries/guitar_dictionary.npy'
+DYNAMICS_THRESHOLD = 1
+PLCA_MAXSTEP = 50
+ONSET_TOP_DB = 80.0
+BATCH_GAP_FRAMES = 32
+BATCH_GROUP_FRAMES = 2048
+# Dictionaries are found relative to the package, not the working directory
+DICT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dictionaries')
+PIANO_DICT_PATH = os.path.join(DICT_DIR, 'piano_dictionary.npy')
+GUITAR_DICT_PATH = os.path.join(DICT_DIR, 'guitar_dictionary.npy')
 CIRCLE_OF_FIFTHS = {
     'C Major': (0, 'Sharps'),
     'G Major': (1, 'Sharps'),
@@ -54,6 +64,62 @@ class Instrument(Enum):
     GUITAR = 48
 
 
+DICT_PATHS = {Instrument.PIANO: PIANO_DICT_PATH, Instrument.GUITAR: GUITAR_DICT_PATH}
+
+
+class Dictionary:
+    # A PLCA dictionary, memory mapped from its file with the forms the pipeline uses worked out once. Every array
+    # is read only so one Dictionary can be shared by threads, and forked worker processes share its pages
+    def __init__(self, instrument, path):
+        self.instrument = instrument
+        self.path = path
+        if not os.path.exists(path):
+            raise Exception("The {} dictionary {} does not exist".format(instrument.name.lower(), path))
+        self.matrix = np.asarray(np.load(path, mmap_mode='r'))
+        # One row per CQT bin and one column per note
+        if np.shape(self.matrix) != (instrument.value, instrument.value):
+            raise Exception("The {} dictionary {} must be {} by {}, not {}".format(
+                instrument.name.lower(), path, instrument.value, instrument.value, np.shape(self.matrix)))
+        if not np.all(np.isfinite(self.matrix)) or np.any(self.matrix < 0):
+            raise Exception("The {} dictionary {} must be finite and non negative".format(instrument.name.lower(),
+                                                                                         path))
+        # Each note's spectrum is a distribution over the CQT bins, whether or not the file was saved normalised
+        self.normalized = self.matrix / np.sum(self.matrix, axis=0)
+        self.float32 = self.normalized.astype(np.float32)
+        for array in (self.normalized, self.float32):
+            array.flags.writeable = False
+
+    def get(self, dtype=None):
+        # The normalised dictionary, in float32 for float32 transcription, so both precisions use the same one
+        if dtype is not None and np.dtype(dtype) == np.float32:
+            return self.float32
+        return self.normalized
+
+
+DICTIONARIES = {}
+DICTIONARIES_LOCK = threading.Lock()
+
+
+def get_dictionary(instrument):
+    # Each dictionary is loaded once per process
+    with DICTIONARIES_LOCK:
+        if instrument not in DICTIONARIES:
+            DICTIONARIES[instrument] = Dictionary(instrument, DICT_PATHS[instrument])
+        return DICTIONARIES[instrument]
+
+
+def validate_dictionaries(instruments=tuple(Instrument)):
+    # Loads the dictionaries up front so a missing or malformed one fails at startup, not during a transcription.
+    # Returns the error of each instrument that failed
+    errors = {}
+    for instrument in instruments:
+        try:
+            get_dictionary(instrument)
+        except Exception as e:
+            errors[instrument] = str(e)
+    return errors
+
+
 def get_note_freq_list():
     freqs = []
     for i in range(-45, 40):
@@ -74,70 +140,207 @@ def open_wav(path):
     return wav_file
 
 
-def estimate_tempo(y, start_bpm=120.0):
-    return librosa.beat.tempo(y=y, sr=SAMPLE_RATE, start_bpm=start_bpm)[0]
+def estimate_onset_envelope(y, max_power=None):
+    if max_power is None:
+        return librosa.onset.onset_strength(y=y, sr=SAMPLE_RATE, hop_length=HOP_LENGTH)
+    # Clips the log mel spectrogram against a given maximum instead of its own, so blocks of a longer signal get
+    # the same envelope they would have as part of it
+    S = librosa.power_to_db(estimate_mel_power(y), top_db=None)
+    S = np.maximum(S, librosa.power_to_db(max_power) - ONSET_TOP_DB)
+    return librosa.onset.onset_strength(S=S, sr=SAMPLE_RATE, hop_length=HOP_LENGTH)
+
+
+def estimate_mel_power(y):
+    return librosa.feature.melspectrogram(y=y, sr=SAMPLE_RATE, hop_length=HOP_LENGTH)
+
 
+def estimate_tempo(y, start_bpm=120.0, onset_envelope=None):
+    return librosa.beat.tempo(y=y, sr=SAMPLE_RATE, onset_envelope=onset_envelope, start_bpm=start_bpm)[0]
 
-def estimate_piano_roll(y, tempo, plca_threshold, note_length_threshold, instrument):
+
+def estimate_piano_roll(y, tempo, plca_threshold, note_length_threshold, instrument, **plca_options):
+    cqt = estimate_cqt(y, instrument)
+    piano_roll = get_piano_roll(cqt, instrument.value, load_dictionary(instrument), tempo, plca_threshold,
+                                note_length_threshold, **plca_options)
+    return cqt, piano_roll
+
+
+def get_cqt_fmin(instrument):
     if instrument == Instrument.PIANO:
-        fmin = 'C2'
-        dictionary = PIANO_DICT_PATH
+        return librosa.note_to_hz('C2')
     else:
-        fmin = 'E2'
-        dictionary = GUITAR_DICT_PATH
-    cqt = librosa.cqt(y,
-                      sr=SAMPLE_RATE,
-                      n_bins=instrument.value,
-                      bins_per_octave=12,
-                      fmin=librosa.note_to_hz(fmin))
-    display_cqt = librosa.cqt(y,
-                              sr=SAMPLE_RATE,
-                              n_bins=300,
-                              bins_per_octave=60,
-                              fmin=librosa.note_to_hz('C2'))
-
-    dictionary = np.load(dictionary)
-    piano_roll = get_piano_roll(cqt, instrument.value, dictionary, tempo, plca_threshold, note_length_threshold)
-    return cqt, piano_roll, display_cqt
-
-
-def get_piano_roll(cqt, number_of_notes, dictionary, tempo, plca_threshold, note_length_threshold):
-    Pt, Pp_t = plca(cqt, number_of_notes, dictionary, maxstep=50)
-    # Thresholding
-    Pp_t[Pp_t < plca_threshold] = 0
-    Pp_t[Pp_t >= plca_threshold] = 1
-    #Dynamics Thresholding
-    Pp_t = Pt * Pp_t
-    Pp_t[Pp_t >= 1] = 1
-    Pp_t[Pp_t < 1] = 0
+        return librosa.note_to_hz('E2')
+
+
+def estimate_cqt(y, instrument, dtype=None):
+    # dtype is the precision wanted for the CQT magnitudes, np.float32 gives a complex64 CQT of float32 samples
+    if dtype is not None:
+        y = np.asarray(y, dtype=dtype)
+        dtype = np.result_type(dtype, np.complex64)
+    return librosa.cqt(y,
+                       sr=SAMPLE_RATE,
+                       n_bins=instrument.value,
+                       bins_per_octave=12,
+                       fmin=get_cqt_fmin(instrument),
+                       dtype=dtype)
+
+
+def estimate_batch_cqt(ys, instrument, gap_frames=BATCH_GAP_FRAMES, dtype=None):
+    # One CQT for many clips. Each clip is padded to whole frames and followed by gap_frames of silence, so no
+    # CQT filter reaches from one clip into the next and each clip's frames are the ones it would get alone
+    lengths = [1 + len(y) // HOP_LENGTH for y in ys]
+    batch = np.zeros((sum(lengths) + gap_frames * len(ys)) * HOP_LENGTH, dtype=dtype or np.float64)
+    starts = np.cumsum([0] + [length + gap_frames for length in lengths[:-1]])
+    for y, start in zip(ys, starts):
+        batch[start * HOP_LENGTH:start * HOP_LENGTH + len(y)] = y
+    cqt = estimate_cqt(batch, instrument, dtype=dtype)
+    return [cqt[:, start:start + length] for start, length in zip(starts, lengths)]
+
+
+def load_dictionary(instrument, dtype=None):
+    return get_dictionary(instrument).get(dtype)
+
+
+def estimate_display_cqt(y):
+    return librosa.cqt(y,
+                       sr=SAMPLE_RATE,
+                       n_bins=300,
+                       bins_per_octave=60,
+                       fmin=librosa.note_to_hz('C2'))
+
+
+def get_active_frames(cqt, energy_floor=DYNAMICS_THRESHOLD):
+    return np.sum(np.abs(cqt), axis=0) >= energy_floor
+
+
+def get_candidate_pitches(cqt, number_of_notes, dictionary, pitch_floor, frame_step=4, maxstep=10, **plca_options):
+    # A short PLCA run on every frame_step-th frame, pitches that never reach pitch_floor there are dropped.
+    # plca_options are those of the main run, e.g. progress_step, method, dtype and cancel
+    _, Pp_t = plca(cqt[:, ::frame_step], number_of_notes, dictionary, maxstep=maxstep, **plca_options)
+    return np.max(Pp_t, axis=1) >= pitch_floor
+
+
+def get_piano_roll(cqt, number_of_notes, dictionary, tempo, plca_threshold, note_length_threshold,
+                   energy_floor=DYNAMICS_THRESHOLD, pitch_floor=None, maxstep=PLCA_MAXSTEP, **plca_options):
+    Pt, Pp_t = get_activations(cqt, number_of_notes, dictionary, energy_floor=energy_floor, pitch_floor=pitch_floor,
+                               maxstep=maxstep, **plca_options)
+    return threshold_activations(Pt, Pp_t, tempo, plca_threshold, note_length_threshold)
+
+
+def get_activations(cqt, number_of_notes, dictionary, energy_floor=DYNAMICS_THRESHOLD, pitch_floor=None,
+                    maxstep=PLCA_MAXSTEP, segments=None, **plca_options):
+    # Frames quieter than the dynamics threshold can never hold a note, so PLCA only runs on the active frames
+    # and the rest keep zero activations. With a pitch_floor PLCA also only runs on the candidate pitches.
+    # plca_options are passed straight to plca, e.g. method='loop'. An init array covers every pitch and frame,
+    # PLCA starts from its part for the active ones. An engine that converges in fewer steps, e.g. 'squarem',
+    # can be given a lower maxstep. segments are the frame counts of clips laid side by side in cqt, see
+    # get_batch_activations
+    active_frames = get_active_frames(cqt, energy_floor)
+    if segments is not None:
+        segments = [np.count_nonzero(part) for part in np.split(active_frames, np.cumsum(segments)[:-1])]
+    pitches = np.ones(number_of_notes, dtype=bool)
+    if pitch_floor is not None and np.any(active_frames):
+        # An init covers every frame and progress belongs to the main run, so neither is passed on
+        pitches = get_candidate_pitches(cqt[:, active_frames], number_of_notes, dictionary, pitch_floor,
+                                        **{name: value for name, value in plca_options.items()
+                                           if name not in ('init', 'progress')})
+    if isinstance(plca_options.get('init'), np.ndarray):
+        plca_options['init'] = plca_options['init'][np.ix_(pitches, active_frames)]
+    # The activations keep the precision PLCA works in
+    dtype = plca_options.get('dtype') or np.finfo(cqt.dtype).dtype
+    Pt = np.zeros(np.shape(cqt)[1], dtype=dtype)
+    Pp_t = np.zeros((number_of_notes, np.shape(cqt)[1]), dtype=dtype)
+    if np.any(active_frames) and np.any(pitches):
+        Pt[active_frames], Pp_t[np.ix_(pitches, active_frames)] = plca(cqt[:, active_frames],
+                                                                       np.count_nonzero(pitches),
+                                                                       dictionary[:, pitches],
+                                                                       maxstep=maxstep, segments=segments,
+                                                                       **plca_options)
+    return Pt, Pp_t
+
+
+def get_batch_activations(cqts, number_of_notes, dictionary, energy_floor=DYNAMICS_THRESHOLD, pitch_floor=None,
+                          group_frames=BATCH_GROUP_FRAMES, **plca_options):
+    # PLCA over the frames of many CQTs at once, split back per CQT. The updates and the Pt of a frame only depend
+    # on that frame and a seeded start is drawn per clip, so each clip gets the activations it would get alone, up
+    # to rounding, as long as neither run stops before maxstep. The methods stop on the entropy of the whole run.
+    # method='active' compacts converged frames across the group and a pitch_floor picks candidate pitches for
+    # the group, so with either a clip only comes close to its single run.
+    # Clips are grouped into runs of about group_frames frames, past that the arrays fall out of cache and a
+    # single run gets slower per frame
+    lengths = [np.shape(cqt)[1] for cqt in cqts]
+    groups = [[]]
+    for i, length in enumerate(lengths):
+        if groups[-1] and sum(lengths[j] for j in groups[-1]) + length > group_frames:
+            groups.append([])
+        groups[-1].append(i)
+    activations = []
+    for group in groups:
+        Pt, Pp_t = get_activations(np.hstack([cqts[i] for i in group]), number_of_notes, dictionary,
+                                   energy_floor=energy_floor, pitch_floor=pitch_floor,
+                                   segments=[lengths[i] for i in group], **plca_options)
+        splits = np.cumsum([lengths[i] for i in group])[:-1]
+        activations.extend(zip(np.split(Pt, splits), np.split(Pp_t, splits, axis=1)))
+    return activations
+
+
+def threshold_activations(Pt, Pp_t, tempo, plca_threshold, note_length_threshold):
+    Pp_t = threshold_dynamics(Pt, Pp_t, plca_threshold)
     # Get rid of frames lower than minimum
     min_frames = get_minimum_frames(tempo, note_length_threshold)
     Pp_t = threshold_minimum_frames(Pp_t, min_frames)
     return Pp_t
 
 
+def threshold_dynamics(Pt, Pp_t, plca_threshold):
+    # Thresholding, into a new array so the activations can be thresholded again
+    Pp_t = np.where(Pp_t >= plca_threshold, 1.0, 0.0)
+    #Dynamics Thresholding
+    Pp_t = Pt * Pp_t
+    Pp_t[Pp_t >= DYNAMICS_THRESHOLD] = 1
+    Pp_t[Pp_t < DYNAMICS_THRESHOLD] = 0
+    return Pp_t
+
+
+def get_runs(data):
+    # Runs of ones along each row as (rows, starts, ends) with exclusive ends, ordered by row then start
+    padded = np.zeros((np.shape(data)[0], np.shape(data)[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = data == 1
+    changes = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(changes == 1)
+    _, ends = np.nonzero(changes == -1)
+    return rows, starts, ends
+
+
+def runs_to_mask(rows, starts, ends, shape):
+    marks = np.zeros((shape[0], shape[1] + 1), dtype=np.int32)
+    np.add.at(marks, (rows, starts), 1)
+    np.add.at(marks, (rows, ends), -1)
+    return np.cumsum(marks, axis=1)[:, :-1] > 0
+
+
+def merge_runs(rows, starts, ends):
+    # Joins overlapping or touching runs on the same row, empty runs are dropped
+    non_empty = starts < ends
+    rows, starts, ends = rows[non_empty], starts[non_empty], ends[non_empty]
+    order = np.lexsort((starts, rows))
+    rows, starts, ends = rows[order], starts[order], ends[order]
+    if rows.size == 0:
+        return rows, starts, ends
+    # Offsetting each row past the end of the previous one lets one running maximum cover every row
+    offset = rows * (np.max(ends) + 1)
+    reach = np.maximum.accumulate(ends + offset)
+    first = np.ones(np.shape(rows), dtype=bool)
+    first[1:] = starts[1:] + offset[1:] > reach[:-1]
+    last = np.append(np.flatnonzero(first)[1:] - 1, rows.size - 1)
+    return rows[first], starts[first], reach[last] - offset[last]
+
+
 def threshold_minimum_frames(data_copy, min_frames):
     data = data_copy.copy()
-    for i in range(np.shape(data)[0]):
-        position_1 = 0
-        position_2 = 0
-        ones_length = 0
-        for j in range(np.shape(data)[1]):
-            if data[i, j] == 1:
-                ones_length += 1
-                if ones_length == 1:
-                    position_1 = j
-            if data[i, j] == 0 and ones_length != 0:
-                position_2 = j
-                if position_2 - position_1 < min_frames:
-                    data[i, position_1:position_2] = 0
-                position_1 = 0
-                position_2 = 0
-                ones_length = 0
-        if ones_length != 0:
-            position_2 = np.shape(data)[1]
-            if position_2 - position_1 < min_frames:
-                data[i, position_1:position_2] = 0
+    rows, starts, ends = get_runs(data)
+    short = ends - starts < min_frames
+    data[runs_to_mask(rows[short], starts[short], ends[short], np.shape(data))] = 0
     return data
 
 
@@ -146,9 +349,10 @@ def get_minimum_frames(tempo, note_length_threshold):
     return round(sixteenth_note_time / TIME_PER_FRAME) - note_length_threshold
 
 
-def estimate_onset_times(data, pre_max=6, post_max=6):
+def estimate_onset_times(data, pre_max=6, post_max=6, onset_envelope=None):
     return librosa.onset.onset_detect(y=data,
                                       sr=SAMPLE_RATE,
+                                      onset_envelope=onset_envelope,
                                       units='frames',
                                       pre_max=pre_max,
                                       post_max=post_max)
@@ -158,27 +362,130 @@ def estimate_onset_times(data, pre_max=6, post_max=6):
     # wait)
 
 
+def get_onset_distances(starts, onsets):
+    # Distance from each start frame to its nearest onset, infinite when there are no onsets
+    onsets = np.sort(np.asarray(onsets))
+    if onsets.size == 0:
+        return np.full(np.shape(starts), np.inf)
+    right = np.searchsorted(onsets, starts)
+    left = np.clip(right - 1, 0, onsets.size - 1)
+    right = np.clip(right, 0, onsets.size - 1)
+    return np.minimum(np.abs(onsets[left] - starts), np.abs(onsets[right] - starts))
+
+
+def get_onset_fills(rows, starts, ends, onsets, n_frames, onset_range=3, prev_note_range=8):
+    # A note starting further than onset_range from any onset is joined to the previous note on the same pitch
+    # when that note ended within prev_note_range frames, by filling the prev_note_range frames before it.
+    # Returns the filled frames as runs, clipped the way a slice of a row n_frames long would be
+    same_row = np.zeros(np.shape(rows), dtype=bool)
+    same_row[1:] = rows[1:] == rows[:-1]
+    previous_ends = np.zeros(np.shape(ends))
+    previous_ends[1:] = ends[:-1]
+    # Notes close to the start of the row only need an earlier note on the same pitch
+    join = (starts != 0) & same_row & (get_onset_distances(starts, onsets) > onset_range) & \
+           ((starts <= prev_note_range) | (previous_ends > starts - prev_note_range))
+    fill_ends = starts[join]
+    fill_starts = fill_ends - prev_note_range
+    fill_starts[fill_starts < 0] = np.maximum(fill_starts[fill_starts < 0] + n_frames, 0)
+    fill_starts = np.minimum(fill_starts, fill_ends)
+    return rows[join], fill_starts, fill_ends
+
+
 def smooth_onsets(data, onsets, onset_range=3, prev_note_range=8):
-    for i in range(np.shape(data)[0]):
-        one_mode = False
-        for j in range(np.shape(data)[1]):
-            if data[i, j] == 1 and not one_mode:
-                one_mode = True
-                closest_onset = onsets[(np.abs(onsets - j)).argmin()]
-                if np.abs(np.min([closest_onset, j]) - np.max([closest_onset, j])) > onset_range:
-                    if j != 0:
-                        if j > prev_note_range:
-                            if data[i, j - prev_note_range:j].max() == 1:
-                                data[i, j - prev_note_range:j] = 1
-                        else:
-                            if data[i, 0:j].max() == 1:
-                                data[i, j - prev_note_range:j] = 1
-            if data[i, j] == 0 and one_mode:
-                one_mode = False
+    rows, starts, ends = get_onset_fills(*get_runs(data), onsets, np.shape(data)[1], onset_range=onset_range,
+                                         prev_note_range=prev_note_range)
+    data[runs_to_mask(rows, starts, ends, np.shape(data))] = 1
+
+
+def smooth_onset_runs(rows, starts, ends, onsets, n_frames, onset_range=3, prev_note_range=8):
+    fills = get_onset_fills(rows, starts, ends, onsets, n_frames, onset_range=onset_range,
+                            prev_note_range=prev_note_range)
+    return merge_runs(*[np.concatenate(runs) for runs in zip((rows, starts, ends), fills)])
+
+
+class PianoRoll:
+    # A binary piano roll kept as runs of sounding frames, (rows, starts, ends) with exclusive ends ordered by row
+    # then start, and the shape of the roll. Its size grows with the number of notes instead of rows * frames, and
+    # each operation returns a new roll without building the dense one
+    def __init__(self, rows, starts, ends, shape):
+        self.rows = np.asarray(rows, dtype=int)
+        self.starts = np.asarray(starts, dtype=int)
+        self.ends = np.asarray(ends, dtype=int)
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_dense(cls, data):
+        return cls(*get_runs(data), np.shape(data))
+
+    @classmethod
+    def from_activations(cls, Pt, Pp_t, plca_threshold):
+        # The cells threshold_dynamics sets, an activation over plca_threshold in a frame with energy over the
+        # dynamics threshold
+        return cls.from_dense((Pp_t >= plca_threshold) & (Pt >= DYNAMICS_THRESHOLD))
+
+    def remove_short(self, min_frames):
+        long_enough = self.ends - self.starts >= min_frames
+        return PianoRoll(self.rows[long_enough], self.starts[long_enough], self.ends[long_enough], self.shape)
+
+    def smooth_onsets(self, onsets, onset_range=3, prev_note_range=8):
+        return PianoRoll(*smooth_onset_runs(self.rows, self.starts, self.ends, onsets, self.shape[1],
+                                            onset_range=onset_range, prev_note_range=prev_note_range), self.shape)
+
+    def pad(self, before, after):
+        # Adds empty pitches below and above, e.g. to place a guitar roll on the piano range
+        return PianoRoll(self.rows + before, self.starts, self.ends, (self.shape[0] + before + after, self.shape[1]))
+
+    def to_dense(self, dtype=bool):
+        return runs_to_mask(self.rows, self.starts, self.ends, self.shape).astype(dtype)
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.starts.nbytes + self.ends.nbytes
+
+
+def iter_wav_blocks(wav_file, block_frames, context_frames):
+    # Reads a wav file in blocks of block_frames frames, with up to context_frames frames of audio either side.
+    # Yields the samples, the first frame of the block, where that frame is in the samples and the frame count
+    n_frames = 1 + wav_file.frames // HOP_LENGTH
+    for first_frame in range(0, n_frames, block_frames):
+        start = max(first_frame - context_frames, 0) * HOP_LENGTH
+        stop = min((first_frame + block_frames + context_frames) * HOP_LENGTH, wav_file.frames)
+        wav_file.seek(start)
+        yield wav_file.read(stop - start), first_frame, first_frame - start // HOP_LENGTH, \
+            min(block_frames, n_frames - first_frame)
+
+
+def stream_activation_runs(wav_file, plca_threshold, instrument, block_frames=4096, context_frames=64,
+                           progress=None, cancel=None, **plca_options):
+    # Transcribes a wav file block by block, only the note runs before the minimum length filter and the onset
+    # strength envelope are kept for the whole file. Runs crossing a block boundary are joined. progress is called
+    # with the fraction of blocks done, cancel is also checked within the PLCA of each block
+    dtype = plca_options.get('dtype')
+    dictionary = load_dictionary(instrument, dtype)
+    n_blocks = -(-(1 + wav_file.frames // HOP_LENGTH) // block_frames)
+    runs = []
+    max_power = 0
+    for i, (samples, first_frame, offset, n_valid) in enumerate(iter_wav_blocks(wav_file, block_frames,
+                                                                                context_frames)):
+        if cancel is not None:
+            cancel.check()
+        valid = slice(offset, offset + n_valid)
+        Pt, Pp_t = get_activations(estimate_cqt(samples, instrument, dtype=dtype)[:, valid], instrument.value,
+                                   dictionary, cancel=cancel, **plca_options)
+        piano_roll = PianoRoll.from_activations(Pt, Pp_t, plca_threshold)
+        runs.append((piano_roll.rows, piano_roll.starts + first_frame, piano_roll.ends + first_frame))
+        max_power = max(max_power, np.max(estimate_mel_power(samples)))
+        if progress is not None:
+            progress((i + 1) / n_blocks)
+    rows, starts, ends = merge_runs(*[np.concatenate(block_runs) for block_runs in zip(*runs)])
+    # The envelope clips against the loudest mel bin of the whole file, so it needs a second pass
+    onset_envelopes = [estimate_onset_envelope(samples, max_power=max_power)[offset:offset + n_valid]
+                       for samples, _, offset, n_valid in iter_wav_blocks(wav_file, block_frames, context_frames)]
+    return rows, starts, ends, np.concatenate(onset_envelopes)
 
 
 def round_to_sixteenth(x):
-    return round(x * 16) / 16
+    return np.round(x * 16) / 16
 
 
 def rotate(l, n):
@@ -0,0 +1,15 @@
+import os
+
+import numpy as np
+
+from amt.cache import FeatureCache
+
+
+def test_partial_entry_is_a_miss(tmp_path):
+    cache = FeatureCache(str(tmp_path))
+    key = cache.key('activations', 'abc')
+    cache.store(key, (np.arange(3.), np.ones((2, 2))))
+    assert [np.shape(array) for array in cache.load(key)] == [(3,), (2, 2)]
+    # As left by another process part way through evicting the entry
+    os.remove(os.path.join(str(tmp_path), key, '1.npy'))
+    assert cache.load(key) is None
@@ -0,0 +1,12 @@
+from amt import utils
+from amt.entities import NoteTable
+
+
+def test_note_table_builds_notes():
+    notes = NoteTable(120, [3, 40], [0, 10], [4, 20])
+    built = list(notes)
+    assert len(built) == 2
+    assert [note.pitch.name for note in built] == [utils.NOTE_NAME_LIST[3], utils.NOTE_NAME_LIST[40]]
+    assert [note.pitch.midi_number for note in built] == list(notes.midi_number)
+    assert notes[1].duration.start_frames == 10
+    assert notes[1].duration.total_frames == 20
@@ -0,0 +1,84 @@
+import numpy as np
+
+from amt.plca import plca
+from amt.utils import load_dictionary, get_activations, get_batch_activations, PianoRoll, Instrument
+
+
+def random_spectrogram(dictionary, tn, seed=0):
+    # A few pitches per frame mixed through the dictionary, plus a little noise so no bin is exactly zero
+    rng = np.random.default_rng(seed)
+    activations = rng.random((np.shape(dictionary)[1], tn)) * (rng.random((np.shape(dictionary)[1], tn)) < 0.05)
+    return dictionary @ activations + 1e-3 * rng.random((np.shape(dictionary)[0], tn))
+
+
+def test_matrix_matches_loop():
+    dictionary = load_dictionary(Instrument.PIANO)
+    V = random_spectrogram(dictionary, 40)
+    Pt_loop, Pp_t_loop = plca(V, Instrument.PIANO.value, dictionary, maxstep=20, progress_step=None, method='loop',
+                              seed=0)
+    Pt_matrix, Pp_t_matrix = plca(V, Instrument.PIANO.value, dictionary, maxstep=20, progress_step=None,
+                                  method='matrix', seed=0)
+    assert np.allclose(Pt_matrix, Pt_loop, rtol=1e-12, atol=0)
+    assert np.allclose(Pp_t_matrix, Pp_t_loop, rtol=0, atol=1e-12)
+
+
+def test_blocked_matches_matrix():
+    dictionary = load_dictionary(Instrument.PIANO)
+    V = random_spectrogram(dictionary, 40)
+    V_copy = V.copy()
+    # A budget for eight frames at a time, so the run spans five blocks
+    memory_budget = 8 * (4 * np.shape(dictionary)[0] + 2 * np.shape(dictionary)[1]) * V.itemsize
+    Pt_matrix, Pp_t_matrix = plca(V, Instrument.PIANO.value, dictionary, maxstep=20, progress_step=None,
+                                  method='matrix', seed=0)
+    Pt_blocked, Pp_t_blocked = plca(V, Instrument.PIANO.value, dictionary, maxstep=20, progress_step=None,
+                                    method='blocked', seed=0, memory_budget=memory_budget)
+    assert np.allclose(Pt_blocked, Pt_matrix, rtol=1e-12, atol=0)
+    assert np.allclose(Pp_t_blocked, Pp_t_matrix, rtol=0, atol=1e-12)
+    # plca hands the engine a copy, which it normalises in place
+    assert np.array_equal(V, V_copy)
+
+
+def test_parallel_matches_matrix():
+    dictionary = load_dictionary(Instrument.PIANO)
+    V = random_spectrogram(dictionary, 40)
+    # Three workers sharing a budget for twelve frames, four frames each, ten blocks
+    memory_budget = 12 * (4 * np.shape(dictionary)[0] + 2 * np.shape(dictionary)[1]) * V.itemsize
+    Pt_matrix, Pp_t_matrix = plca(V, Instrument.PIANO.value, dictionary, maxstep=20, progress_step=None,
+                                  method='matrix', seed=0)
+    Pt_parallel, Pp_t_parallel = plca(V, Instrument.PIANO.value, dictionary, maxstep=20, progress_step=None,
+                                      method='parallel', seed=0, workers=3, memory_budget=memory_budget)
+    assert np.allclose(Pt_parallel, Pt_matrix, rtol=1e-12, atol=0)
+    assert np.allclose(Pp_t_parallel, Pp_t_matrix, rtol=0, atol=1e-12)
+
+
+def test_batch_matches_single_clips():
+    dictionary = load_dictionary(Instrument.PIANO)
+    cqts = [random_spectrogram(dictionary, tn, seed=tn) for tn in (37, 80, 15, 64)]
+    # A quiet frame is skipped, so clips run on fewer frames than they have
+    cqts[1][:, 10] *= 1e-6
+    for options in ({'seed': 0}, {'init': 'projection'}):
+        batch = get_batch_activations(cqts, Instrument.PIANO.value, dictionary, maxstep=20, progress_step=None,
+                                      **options)
+        for cqt, (Pt, Pp_t) in zip(cqts, batch):
+            Pt_single, Pp_t_single = get_activations(cqt, Instrument.PIANO.value, dictionary, maxstep=20,
+                                                     progress_step=None, **options)
+            assert np.allclose(Pt, Pt_single, rtol=1e-12, atol=0)
+            assert np.allclose(Pp_t, Pp_t_single, rtol=0, atol=1e-12)
+
+
+def test_float32_matches_float64():
+    dictionary = load_dictionary(Instrument.PIANO)
+    V = random_spectrogram(dictionary, 400)
+    Pt_64, Pp_t_64 = get_activations(V, Instrument.PIANO.value, dictionary, progress_step=None, seed=0)
+    Pt_32, Pp_t_32 = get_activations(V.astype(np.float32), Instrument.PIANO.value,
+                                     load_dictionary(Instrument.PIANO, np.float32), progress_step=None, seed=0,
+                                     dtype=np.float32)
+    # Nothing on the way upcasts to float64
+    assert Pt_32.dtype == np.float32 and Pp_t_32.dtype == np.float32
+    assert np.allclose(Pt_32, Pt_64, rtol=1e-5, atol=0)
+    assert np.allclose(Pp_t_32, Pp_t_64, rtol=0, atol=1e-5)
+    piano_roll_64 = PianoRoll.from_activations(Pt_64, Pp_t_64, 0.1)
+    piano_roll_32 = PianoRoll.from_activations(Pt_32, Pp_t_32, 0.1)
+    assert np.array_equal(piano_roll_32.rows, piano_roll_64.rows)
+    assert np.array_equal(piano_roll_32.starts, piano_roll_64.starts)
+    assert np.array_equal(piano_roll_32.ends, piano_roll_64.ends)
@@ -0,0 +1,79 @@
+import numpy as np
+
+from amt.utils import threshold_minimum_frames, smooth_onsets, PianoRoll
+
+
+def reference_threshold_minimum_frames(data_copy, min_frames):
+    # The frame by frame implementation the run based one replaced
+    data = data_copy.copy()
+    for i in range(np.shape(data)[0]):
+        position_1 = 0
+        ones_length = 0
+        for j in range(np.shape(data)[1]):
+            if data[i, j] == 1:
+                ones_length += 1
+                if ones_length == 1:
+                    position_1 = j
+            if data[i, j] == 0 and ones_length != 0:
+                if j - position_1 < min_frames:
+                    data[i, position_1:j] = 0
+                ones_length = 0
+        if ones_length != 0 and np.shape(data)[1] - position_1 < min_frames:
+            data[i, position_1:] = 0
+    return data
+
+
+def reference_smooth_onsets(data, onsets, onset_range=3, prev_note_range=8):
+    for i in range(np.shape(data)[0]):
+        one_mode = False
+        for j in range(np.shape(data)[1]):
+            if data[i, j] == 1 and not one_mode:
+                one_mode = True
+                closest_onset = onsets[(np.abs(onsets - j)).argmin()]
+                if np.abs(np.min([closest_onset, j]) - np.max([closest_onset, j])) > onset_range:
+                    if j != 0:
+                        if j > prev_note_range:
+                            if data[i, j - prev_note_range:j].max() == 1:
+                                data[i, j - prev_note_range:j] = 1
+                        else:
+                            if data[i, 0:j].max() == 1:
+                                data[i, j - prev_note_range:j] = 1
+            if data[i, j] == 0 and one_mode:
+                one_mode = False
+
+
+def random_rolls(count, seed=0):
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        shape = (rng.integers(1, 6), rng.integers(1, 80))
+        # Runs of varied length from a sticky random walk, prev_note_range starts at one as the original loop
+        # fails on an empty slice
+        roll = (rng.random(shape) < rng.uniform(0.05, 0.6)).astype(float)
+        for j in range(1, shape[1]):
+            roll[:, j] = np.where(rng.random(shape[0]) < rng.uniform(0, 0.8), roll[:, j - 1], roll[:, j])
+        onsets = np.unique(rng.integers(0, shape[1] + 5, rng.integers(1, 8)))
+        yield roll, onsets, rng.integers(0, 10), rng.integers(0, 6), rng.integers(1, 12)
+
+
+def test_threshold_minimum_frames_matches_reference():
+    for roll, _, min_frames, _, _ in random_rolls(500):
+        assert np.array_equal(threshold_minimum_frames(roll, min_frames),
+                              reference_threshold_minimum_frames(roll, min_frames))
+
+
+def test_smooth_onsets_matches_reference():
+    for roll, onsets, _, onset_range, prev_note_range in random_rolls(500, seed=1):
+        expected = roll.copy()
+        reference_smooth_onsets(expected, onsets, onset_range, prev_note_range)
+        smoothed = roll.copy()
+        smooth_onsets(smoothed, onsets, onset_range, prev_note_range)
+        assert np.array_equal(smoothed, expected)
+
+
+def test_piano_roll_matches_dense_post_processing():
+    for roll, onsets, min_frames, onset_range, prev_note_range in random_rolls(500, seed=2):
+        expected = reference_threshold_minimum_frames(roll, min_frames)
+        reference_smooth_onsets(expected, onsets, onset_range, prev_note_range)
+        piano_roll = PianoRoll.from_dense(roll).remove_short(min_frames).smooth_onsets(onsets, onset_range,
+                                                                                        prev_note_range)
+        assert np.array_equal(piano_roll.to_dense(float), expected)